@@ -3,23 +3,177 @@
 Enhanced Shipment Management API Server
 """
 
+import asyncio
 import uvicorn
-from fastapi import FastAPI, HTTPException, Depends, Query
-from fastapi.security import OAuth2PasswordRequestForm
+from fastapi import FastAPI, BackgroundTasks, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
-from sqlmodel import Session, SQLModel, create_engine, select, Field, or_, and_
+from sqlmodel import Session, SQLModel, create_engine, select, Field, or_, and_, func
+from sqlalchemy import Index, delete, event, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session as OrmSession
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from typing import Optional, List, Dict, Any
 from passlib.context import CryptContext
+from jose import JWTError, jwt
 from datetime import datetime, timedelta, date
 from enum import Enum
+import bisect
+import json
+import math
+import os
 import random
+import re
+import secrets
+import sqlite3
+import sys
+import threading
+import time
 import uuid
-from pydantic import BaseModel
+import cProfile
+import functools
+import gzip
+import hashlib
+import io
+import pstats
+from collections import OrderedDict
+from contextvars import ContextVar, copy_context
+import numpy as np
+from pydantic import BaseModel, confloat, field_validator
 
 # Database setup
 DATABASE_URL = "sqlite:///./indian_shipment.db"
 engine = create_engine(DATABASE_URL, echo=False)
 
+# Auth settings
+SECRET_KEY = os.getenv("SECRET_KEY")
+if not SECRET_KEY:
+    # Never fall back to a shared default; tokens from this key die with the process
+    SECRET_KEY = secrets.token_urlsafe(32)
+    print("⚠️ SECRET_KEY is not set - using a random per-process key; tokens will not survive a restart")
+ALGORITHM = "HS256"
+ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 8
+PRINCIPAL_CACHE_TTL_SECONDS = 60
+PRINCIPAL_CACHE_MAX_SIZE = 10000
+
+# Routing network settings
+HUB_NEIGHBOURS = 3  # each hub gets lanes to its nearest hubs, on top of a spanning tree
+ROAD_DISTANCE_FACTOR = 1.25  # road km per great-circle km
+HUB_LOCATION_CACHE_SIZE = 4096  # locations are free text from clients, so the cache must be bounded
+
+# Admission control settings
+RATE_LIMIT_ENABLED = True
+HEAVY_MAX_IN_FLIGHT = 4
+HEAVY_MAX_QUEUE = 16
+HEAVY_QUEUE_TIMEOUT_SECONDS = 5.0
+RATE_LIMIT_MAX_CLIENTS = 50000
+
+# Responses smaller than this are sent uncompressed
+GZIP_MINIMUM_SIZE = 1024
+
+# Diagnostics: both off by default; with neither set no hooks are installed at all
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "0"))  # 0 disables the slow-query log
+REQUEST_PROFILING_ENABLED = os.getenv("REQUEST_PROFILING_ENABLED", "0") == "1"
+PROFILE_TOP_N = 20
+
+# Analytics read from a periodically refreshed read-only copy of the database
+ANALYTICS_SNAPSHOT_ENABLED = True
+ANALYTICS_SNAPSHOT_INTERVAL_SECONDS = 300
+ANALYTICS_FORCE_LIVE = os.getenv("ANALYTICS_FORCE_LIVE", "0") == "1"
+
+# In-memory index of active shipments for status-board queries
+SHIPMENT_INDEX_ENABLED = True
+
+# Idempotency-Key replay window
+IDEMPOTENCY_TTL_HOURS = 24
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = 300
+
+# Archival settings: terminal shipments untouched for this long move to the archive tables
+ARCHIVER_ENABLED = True
+ARCHIVE_INTERVAL_SECONDS = 3600
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_BATCH_SIZE = 500
+
+# ETA settings: lanes need this many deliveries before their stats are trusted
+LANE_STATS_MIN_SAMPLES = 3
+LANE_ETA_PERCENTILE = "p90_days"
+
+# SLA-breach scanner settings
+SLA_SCANNER_ENABLED = True
+SLA_SCAN_INTERVAL_SECONDS = 300
+SLA_SCAN_BATCH_SIZE = 500
+
+# Sample Indian cities for origins and destinations
+INDIAN_CITIES = [
+    ("Mumbai", "India", "400001"),
+    ("Delhi", "India", "110001"),
+    ("Bangalore", "India", "560001"),
+    ("Hyderabad", "India", "500001"),
+    ("Chennai", "India", "600001"),
+    ("Kolkata", "India", "700001"),
+    ("Pune", "India", "411001"),
+    ("Ahmedabad", "India", "380001"),
+    ("Jaipur", "India", "302001"),
+    ("Surat", "India", "395001"),
+    ("Lucknow", "India", "226001"),
+    ("Kanpur", "India", "208001"),
+    ("Nagpur", "India", "440001"),
+    ("Indore", "India", "452001"),
+    ("Thane", "India", "400601"),
+    ("Bhopal", "India", "462001"),
+    ("Visakhapatnam", "India", "530001"),
+    ("Pimpri-Chinchwad", "India", "411017"),
+    ("Patna", "India", "800001"),
+    ("Vadodara", "India", "390001"),
+    ("Ghaziabad", "India", "201001"),
+    ("Ludhiana", "India", "141001"),
+    ("Agra", "India", "282001"),
+    ("Nashik", "India", "422001"),
+    ("Faridabad", "India", "121001"),
+    ("Meerut", "India", "250001"),
+    ("Rajkot", "India", "360001"),
+    ("Kalyan-Dombivali", "India", "421201"),
+    ("Vasai-Virar", "India", "401201"),
+    ("Varanasi", "India", "221001")
+]
+
+# Hub coordinates (latitude, longitude) for the routing network
+CITY_COORDINATES = {
+    "Mumbai": (19.0760, 72.8777),
+    "Delhi": (28.7041, 77.1025),
+    "Bangalore": (12.9716, 77.5946),
+    "Hyderabad": (17.3850, 78.4867),
+    "Chennai": (13.0827, 80.2707),
+    "Kolkata": (22.5726, 88.3639),
+    "Pune": (18.5204, 73.8567),
+    "Ahmedabad": (23.0225, 72.5714),
+    "Jaipur": (26.9124, 75.7873),
+    "Surat": (21.1702, 72.8311),
+    "Lucknow": (26.8467, 80.9462),
+    "Kanpur": (26.4499, 80.3319),
+    "Nagpur": (21.1458, 79.0882),
+    "Indore": (22.7196, 75.8577),
+    "Thane": (19.2183, 72.9781),
+    "Bhopal": (23.2599, 77.4126),
+    "Visakhapatnam": (17.6868, 83.2185),
+    "Pimpri-Chinchwad": (18.6298, 73.7997),
+    "Patna": (25.5941, 85.1376),
+    "Vadodara": (22.3072, 73.1812),
+    "Ghaziabad": (28.6692, 77.4538),
+    "Ludhiana": (30.9010, 75.8573),
+    "Agra": (27.1767, 78.0081),
+    "Nashik": (19.9975, 73.7898),
+    "Faridabad": (28.4089, 77.3178),
+    "Meerut": (28.9845, 77.7064),
+    "Rajkot": (22.3039, 70.8022),
+    "Kalyan-Dombivali": (19.2403, 73.1305),
+    "Vasai-Virar": (19.3919, 72.8397),
+    "Varanasi": (25.3176, 82.9739)
+}
+
 # Enums
 class ShipmentStatus(str, Enum):
     PENDING = "pending"
@@ -73,11 +227,10 @@ class Customer(SQLModel, table=True):
     total_shipments: int = 0
     total_value: float = 0.0
 
-# Enhanced Shipment model
-class Shipment(SQLModel, table=True):
-    id: Optional[int] = Field(default=None, primary_key=True)
+# Enhanced Shipment model (columns shared by the live and archive tables)
+class ShipmentBase(SQLModel):
     tracking_number: str = Field(unique=True, index=True)
-    customer_id: Optional[int] = Field(foreign_key="customer.id")
+    customer_id: Optional[int] = Field(foreign_key="customer.id", index=True)
 
     # Status and Priority
     status: ShipmentStatus = ShipmentStatus.PENDING
@@ -107,7 +260,7 @@ class Shipment(SQLModel, table=True):
     created_at: datetime = Field(default_factory=datetime.utcnow)
     pickup_date: Optional[datetime] = None
     estimated_delivery_date: Optional[date] = None
-    actual_delivery_date: Optional[datetime] = None
+    actual_delivery_date: Optional[datetime] = Field(default=None, index=True)
 
     # Costs
     shipping_cost: Optional[float] = None
@@ -118,18 +271,52 @@ class Shipment(SQLModel, table=True):
     current_location: Optional[str] = None
     last_update: datetime = Field(default_factory=datetime.utcnow)
 
-# Tracking Event model
-class TrackingEvent(SQLModel, table=True):
+class Shipment(ShipmentBase, table=True):
+    __table_args__ = (
+        # Lets the SLA scanner range-scan overdue shipments per status
+        Index("ix_shipment_status_estimated_delivery_date", "status", "estimated_delivery_date"),
+        # Lets a lane statistics refresh read only that lane's deliveries
+        Index("ix_shipment_lane", "origin_city", "destination_city", "priority", "status"),
+        # Archived rows keep their ids, so freed ids must never be handed out again
+        {"sqlite_autoincrement": True},
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
-    shipment_id: int = Field(foreign_key="shipment.id")
+
+# Archived shipments keep their original id so archived events still line up
+class ShipmentArchive(ShipmentBase, table=True):
+    __table_args__ = (Index("ix_shipmentarchive_lane", "origin_city", "destination_city", "priority", "status"),)
+
+    id: int = Field(primary_key=True)
+    archived_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Tracking Event model
+class TrackingEventBase(SQLModel):
     status: ShipmentStatus
     location: str
     description: str
     timestamp: datetime = Field(default_factory=datetime.utcnow)
     created_by: Optional[str] = None
 
+class TrackingEvent(TrackingEventBase, table=True):
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    shipment_id: int = Field(foreign_key="shipment.id", index=True)
+
+class TrackingEventArchive(TrackingEventBase, table=True):
+    id: int = Field(primary_key=True)
+    shipment_id: int = Field(foreign_key="shipmentarchive.id", index=True)
+
 # Notification model
 class Notification(SQLModel, table=True):
+    # Each inbox query reads only its own rows, already in order, with no sort
+    __table_args__ = (
+        Index("ix_notification_user_id_read_created_at", "user_id", "read", "created_at"),  # unread_only listing
+        Index("ix_notification_user_id_created_at_id", "user_id", "created_at", "id"),  # newest-first listing
+        Index("ix_notification_user_id_id", "user_id", "id"),  # long-poll for ids after a cursor
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: Optional[int] = Field(foreign_key="user.id")
     title: str
@@ -138,6 +325,52 @@ class Notification(SQLModel, table=True):
     read: bool = False
     created_at: datetime = Field(default_factory=datetime.utcnow)
 
+# Unread notification count per user, maintained alongside notification writes
+class NotificationCounter(SQLModel, table=True):
+    user_id: int = Field(primary_key=True, foreign_key="user.id")
+    unread: int = 0
+
+# Stored response for a client-supplied Idempotency-Key, kept until expires_at
+class IdempotencyRecord(SQLModel, table=True):
+    key: str = Field(primary_key=True)  # "<scope>:<client key>"
+    request_hash: str
+    status_code: int = 200
+    response_body: str
+    expires_at: datetime = Field(index=True)
+
+# Transit-time summary per lane, refreshed as shipments are delivered
+class LaneStats(SQLModel, table=True):
+    origin_city: str = Field(primary_key=True)
+    destination_city: str = Field(primary_key=True)
+    priority: ShipmentPriority = Field(primary_key=True)
+    sample_count: int = 0
+    mean_days: float = 0.0
+    min_days: float = 0.0
+    p50_days: float = 0.0
+    p90_days: float = 0.0
+    p95_days: float = 0.0
+    max_days: float = 0.0
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Mergeable delivery-time sketch per analytics dimension ("all", "priority", "lane", "month")
+class DeliverySketch(SQLModel, table=True):
+    dimension: str = Field(primary_key=True)
+    key: str = Field(primary_key=True)
+    count: int = 0
+    total_hours: float = 0.0
+    min_hours: Optional[float] = None
+    max_hours: Optional[float] = None
+    buckets: str = "{}"  # JSON {bucket index: count}
+    day_histogram: str = "[]"  # JSON counts per HISTOGRAM_DAY_EDGES range
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+# Progress marker for incremental scans over the shipment table
+class ScanWatermark(SQLModel, table=True):
+    name: str = Field(primary_key=True)
+    last_timestamp: Optional[datetime] = None
+    last_id: int = 0
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
 # Pydantic models for API
 class ShipmentCreate(BaseModel):
     customer_id: Optional[int] = None
@@ -150,15 +383,22 @@ class ShipmentCreate(BaseModel):
     destination_city: str
     destination_country: str
     destination_postal_code: Optional[str] = None
-    weight: float
+    weight: confloat(gt=0, allow_inf_nan=False)
     dimensions: Optional[str] = None
-    declared_value: Optional[float] = None
+    declared_value: Optional[confloat(ge=0, allow_inf_nan=False)] = None
     insurance_required: bool = False
     fragile: bool = False
     description: Optional[str] = None
     special_instructions: Optional[str] = None
     estimated_delivery_date: Optional[date] = None
 
+    @field_validator("dimensions")
+    @classmethod
+    def check_dimensions(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None:
+            parse_dimensions(value)
+        return value
+
 class ShipmentUpdate(BaseModel):
     status: Optional[ShipmentStatus] = None
     priority: Optional[ShipmentPriority] = None
@@ -193,6 +433,59 @@ class DashboardStats(BaseModel):
     avg_delivery_time: float
     on_time_delivery_rate: float
 
+class RateCard(BaseModel):
+    base_cost: confloat(ge=0, allow_inf_nan=False) = 10.0
+    rate_per_kg: confloat(gt=0, allow_inf_nan=False) = 2.5
+    dim_divisor: confloat(gt=0, allow_inf_nan=False) = 5000.0  # cm³ per chargeable kg
+    insurance_rate: confloat(ge=0, allow_inf_nan=False) = 0.01
+    priority_multipliers: Dict[ShipmentPriority, confloat(gt=0, allow_inf_nan=False)] = {
+        ShipmentPriority.LOW: 0.9,
+        ShipmentPriority.NORMAL: 1.0,
+        ShipmentPriority.HIGH: 1.25,
+        ShipmentPriority.URGENT: 1.5
+    }
+    lane_multipliers: Dict[str, confloat(gt=0, allow_inf_nan=False)] = {}  # "Origin->Destination": multiplier
+
+class QuoteRequest(BaseModel):
+    origin_city: str
+    destination_city: str
+    weight: confloat(gt=0, allow_inf_nan=False)
+    dimensions: Optional[str] = None
+    priority: ShipmentPriority = ShipmentPriority.NORMAL
+    declared_value: Optional[confloat(ge=0, allow_inf_nan=False)] = None
+    insurance_required: bool = False
+
+    @field_validator("dimensions")
+    @classmethod
+    def check_dimensions(cls, value: Optional[str]) -> Optional[str]:
+        if value is not None:
+            parse_dimensions(value)
+        return value
+
+class QuoteBatchRequest(BaseModel):
+    items: List[QuoteRequest]
+
+class RouteBatchRequest(BaseModel):
+    shipment_ids: List[int] = []
+    lanes: List[Dict[str, str]] = []  # [{"from": city, "to": city}]
+
+class RouteLimit(BaseModel):
+    pattern: str  # regex matched against the full request path
+    methods: List[str] = ["GET", "POST", "PUT", "DELETE"]
+    rate: float  # tokens refilled per second, per client
+    burst: int
+    heavy: bool = False  # counts against HEAVY_MAX_IN_FLIGHT
+
+class UserPrincipal(BaseModel):
+    id: int
+    username: str
+    email: str
+    full_name: Optional[str] = None
+    role: UserRole
+    company: Optional[str] = None
+    phone: Optional[str] = None
+    is_active: bool
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -202,9 +495,302 @@ def get_password_hash(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
-def generate_tracking_number() -> str:
-    """Generate a unique tracking number"""
-    return f"ST{random.randint(100000, 999999)}"
+def create_access_token(user: User) -> str:
+    """Issue a signed access token that can be verified without a DB lookup"""
+    now = datetime.utcnow()
+    claims = {
+        "sub": str(user.id),
+        "username": user.username,
+        "role": user.role.value,
+        "iat": now,
+        "exp": now + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    }
+    return jwt.encode(claims, SECRET_KEY, algorithm=ALGORITHM)
+
+class PrincipalCache:
+    """Small TTL/LRU cache of user principals keyed by user id"""
+
+    def __init__(self, ttl_seconds: float, max_size: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.entries: "OrderedDict[int, tuple]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[UserPrincipal]:
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if not entry:
+                return None
+            expires_at, principal = entry
+            if expires_at < time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return principal
+
+    def put(self, principal: UserPrincipal):
+        with self.lock:
+            self.entries[principal.id] = (time.monotonic() + self.ttl_seconds, principal)
+            self.entries.move_to_end(principal.id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_TTL_SECONDS, PRINCIPAL_CACHE_MAX_SIZE)
+
+# ORM-level user changes drop the cached principal; bulk UPDATE statements bypass these hooks
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def invalidate_user_principal(mapper, connection, target: User):
+    principal_cache.invalidate(target.id)
+
+class TableVersions:
+    """In-process change counters per table, bumped when a write commits.
+
+    Backs the weak ETags on list and tracking endpoints. The boot id keeps
+    ETags from a previous process from ever matching.
+    """
+
+    def __init__(self):
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.versions: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def bump(self, tables):
+        with self.lock:
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+
+    def etag(self, tables) -> str:
+        with self.lock:
+            parts = [f"{table}.{self.versions.get(table, 0)}" for table in tables]
+        return f'W/"{self.boot_id}-{"-".join(parts)}"'
+
+table_versions = TableVersions()
+
+def _touched_tables(session) -> set:
+    return session.info.setdefault("touched_tables", set())
+
+@event.listens_for(OrmSession, "after_flush")
+def track_flushed_tables(session, flush_context):
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        _touched_tables(session).add(instance.__table__.name)
+
+@event.listens_for(OrmSession, "do_orm_execute")
+def track_bulk_statement_tables(orm_execute_state):
+    if orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert:
+        mapper = orm_execute_state.bind_mapper
+        if mapper is not None:
+            _touched_tables(orm_execute_state.session).add(mapper.local_table.name)
+
+@event.listens_for(OrmSession, "after_commit")
+def bump_committed_tables(session):
+    tables = session.info.pop("touched_tables", None)
+    if tables:
+        table_versions.bump(tables)
+
+@event.listens_for(OrmSession, "after_rollback")
+def forget_rolled_back_tables(session):
+    session.info.pop("touched_tables", None)
+
+class HubNetwork:
+    """Hub graph with all-pairs shortest paths precomputed at load time.
+
+    dist[i, j] is the road distance in km and next_hop[i, j] the hub to move to
+    from i on the way to j, so per-shipment lookups are two array reads.
+    """
+
+    def __init__(self, coordinates: Dict[str, tuple], neighbours: int = HUB_NEIGHBOURS):
+        self.hubs = list(coordinates)
+        self.index = {hub: i for i, hub in enumerate(self.hubs)}
+        # Longest names first so "Pimpri-Chinchwad ..." never resolves to a shorter prefix
+        self.hubs_by_length = sorted(self.hubs, key=len, reverse=True)
+        self.locate = functools.lru_cache(maxsize=HUB_LOCATION_CACHE_SIZE)(self._locate)
+
+        lat, lon = np.radians(np.array([coordinates[h] for h in self.hubs])).T
+        # Haversine distance between every pair of hubs
+        a = (np.sin((lat[:, None] - lat[None, :]) / 2) ** 2
+             + np.cos(lat[:, None]) * np.cos(lat[None, :]) * np.sin((lon[:, None] - lon[None, :]) / 2) ** 2)
+        road_km = 2 * 6371 * np.arcsin(np.sqrt(a)) * ROAD_DISTANCE_FACTOR
+
+        self.lanes = self._build_lanes(road_km, neighbours)
+        n = len(self.hubs)
+        dist = np.full((n, n), np.inf)
+        np.fill_diagonal(dist, 0)
+        next_hop = np.tile(np.arange(n), (n, 1))
+        for i, j in self.lanes:
+            dist[i, j] = dist[j, i] = road_km[i, j]
+
+        # Floyd-Warshall, vectorized over each intermediate hub
+        for k in range(n):
+            via = dist[:, k, None] + dist[None, k, :]
+            better = via < dist
+            dist = np.where(better, via, dist)
+            next_hop = np.where(better, next_hop[:, k, None], next_hop)
+
+        self.dist = dist
+        self.next_hop = next_hop
+
+    @staticmethod
+    def _build_lanes(road_km, neighbours: int) -> set:
+        """Lanes from a minimum spanning tree (keeps the graph connected) plus nearest neighbours"""
+        n = len(road_km)
+        lanes = set()
+        in_tree = np.zeros(n, dtype=bool)
+        in_tree[0] = True
+        best = road_km[0].copy()
+        parent = np.zeros(n, dtype=int)
+        for _ in range(n - 1):
+            candidate = np.where(in_tree, np.inf, best)
+            j = int(np.argmin(candidate))
+            lanes.add((min(j, int(parent[j])), max(j, int(parent[j]))))
+            in_tree[j] = True
+            closer = road_km[j] < best
+            best = np.where(closer, road_km[j], best)
+            parent = np.where(closer, j, parent)
+
+        nearest = np.argsort(road_km, axis=1)[:, 1:neighbours + 1]
+        for i in range(n):
+            for j in nearest[i]:
+                lanes.add((min(i, int(j)), max(i, int(j))))
+        return lanes
+
+    def _locate(self, location: Optional[str]) -> Optional[int]:
+        """Hub index for a city name or a location like "Pune Distribution Center"; cached as self.locate"""
+        if not location:
+            return None
+        match = next((hub for hub in self.hubs_by_length if location.startswith(hub)), None)
+        return self.index[match] if match else None
+
+    def path(self, origin: int, destination: int) -> List[str]:
+        hops = [self.hubs[origin]]
+        while origin != destination:
+            origin = int(self.next_hop[origin, destination])
+            hops.append(self.hubs[origin])
+        return hops
+
+    def route(self, origin_city: str, destination_city: str, current_location: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        origin = self.locate(origin_city)
+        destination = self.locate(destination_city)
+        if origin is None or destination is None:
+            return None
+        current = self.locate(current_location)
+        if current is None:
+            current = origin
+        return {
+            "path": self.path(origin, destination),
+            "current_hub": self.hubs[current],
+            "next_hop": self.hubs[int(self.next_hop[current, destination])] if current != destination else None,
+            "total_distance_km": round(float(self.dist[origin, destination]), 1),
+            "remaining_distance_km": round(float(self.dist[current, destination]), 1)
+        }
+
+    def _indices(self, locations) -> np.ndarray:
+        """Hub index per location, -1 where it isn't on the network"""
+        indices = [self.locate(location) for location in locations]
+        return np.array([-1 if i is None else i for i in indices], dtype=np.int64)
+
+    def route_many(self, origins, destinations, currents) -> Dict[str, Any]:
+        """Next hop and distances for many (origin, destination, current location) rows at once"""
+        origin_idx = self._indices(origins)
+        dest_idx = self._indices(destinations)
+        current_idx = self._indices(currents)
+        current_idx = np.where(current_idx < 0, origin_idx, current_idx)
+
+        known = (origin_idx >= 0) & (dest_idx >= 0)
+        o, d, c = np.where(known, origin_idx, 0), np.where(known, dest_idx, 0), np.where(known, current_idx, 0)
+        next_idx = self.next_hop[c, d]
+        hub_names = np.array(self.hubs + [None], dtype=object)
+        return {
+            "known": known,
+            "current_hub": hub_names[np.where(known, c, -1)],
+            "next_hop": hub_names[np.where(known & (c != d), next_idx, -1)],
+            "total_distance_km": np.round(self.dist[o, d], 1),
+            "remaining_distance_km": np.round(self.dist[c, d], 1)
+        }
+
+hub_network = HubNetwork(CITY_COORDINATES)
+
+last_idempotency_purge = 0.0
+
+def idempotency_fingerprint(payload: BaseModel) -> str:
+    return hashlib.sha256(json.dumps(payload.model_dump(mode="json"), sort_keys=True).encode()).hexdigest()
+
+def find_idempotent_replay(session: Session, key: str, request_hash: str) -> Optional[JSONResponse]:
+    """Return the stored response for a key, or None if the key is new or expired"""
+    record = session.get(IdempotencyRecord, key)
+    if not record or record.expires_at < datetime.utcnow():
+        return None
+    if record.request_hash != request_hash:
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+    return JSONResponse(
+        status_code=record.status_code,
+        content=json.loads(record.response_body),
+        headers={"Idempotent-Replayed": "true"}
+    )
+
+def stage_idempotent_response(session: Session, key: str, request_hash: str, body: Dict[str, Any]):
+    """Stage the response so it commits atomically with the write it describes"""
+    global last_idempotency_purge
+    now = datetime.utcnow()
+    session.merge(IdempotencyRecord(
+        key=key,
+        request_hash=request_hash,
+        response_body=json.dumps(body),
+        expires_at=now + timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+    ))
+
+    # Evict expired keys every so often so the table stays bounded by TTL x write rate
+    if time.monotonic() - last_idempotency_purge > IDEMPOTENCY_PURGE_INTERVAL_SECONDS:
+        last_idempotency_purge = time.monotonic()
+        session.exec(delete(IdempotencyRecord).where(IdempotencyRecord.expires_at < now))
+
+def run_idempotent(db: Session, scope: str, idempotency_key: Optional[str], payload: BaseModel, create):
+    """Run create() once per Idempotency-Key; replays return the first response without re-running it.
+
+    create() must stage its writes without committing and return the response body.
+    """
+    if not idempotency_key:
+        body = create()
+        db.commit()
+        return body
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key must be at most 255 characters")
+
+    key = f"{scope}:{idempotency_key}"
+    request_hash = idempotency_fingerprint(payload)
+    replay = find_idempotent_replay(db, key, request_hash)
+    if replay:
+        return replay
+
+    body = create()
+    stage_idempotent_response(db, key, request_hash, body)
+    try:
+        db.commit()
+    except IntegrityError:
+        # A concurrent retry with the same key won the race; hand back its response
+        db.rollback()
+        replay = find_idempotent_replay(db, key, request_hash)
+        if replay:
+            return replay
+        raise
+    return body
+
+def generate_tracking_number(session: Optional[Session] = None) -> str:
+    """Generate a unique tracking number, not used by any live or archived shipment"""
+    while True:
+        tracking_number = f"ST{random.randint(100000, 999999)}"
+        if session is None:
+            return tracking_number
+        taken = any(
+            session.exec(select(model.id).where(model.tracking_number == tracking_number)).first()
+            for model in (Shipment, ShipmentArchive)
+        )
+        if not taken:
+            return tracking_number
 
 def create_sample_customers(session: Session):
     """Create sample customers with realistic Indian data"""
@@ -309,39 +895,7 @@ def create_sample_shipments(session: Session):
     """Create sample shipments with realistic data"""
     customers = session.exec(select(Customer)).all()
 
-    # Sample Indian cities for origins and destinations
-    cities = [
-        ("Mumbai", "India", "400001"),
-        ("Delhi", "India", "110001"),
-        ("Bangalore", "India", "560001"),
-        ("Hyderabad", "India", "500001"),
-        ("Chennai", "India", "600001"),
-        ("Kolkata", "India", "700001"),
-        ("Pune", "India", "411001"),
-        ("Ahmedabad", "India", "380001"),
-        ("Jaipur", "India", "302001"),
-        ("Surat", "India", "395001"),
-        ("Lucknow", "India", "226001"),
-        ("Kanpur", "India", "208001"),
-        ("Nagpur", "India", "440001"),
-        ("Indore", "India", "452001"),
-        ("Thane", "India", "400601"),
-        ("Bhopal", "India", "462001"),
-        ("Visakhapatnam", "India", "530001"),
-        ("Pimpri-Chinchwad", "India", "411017"),
-        ("Patna", "India", "800001"),
-        ("Vadodara", "India", "390001"),
-        ("Ghaziabad", "India", "201001"),
-        ("Ludhiana", "India", "141001"),
-        ("Agra", "India", "282001"),
-        ("Nashik", "India", "422001"),
-        ("Faridabad", "India", "121001"),
-        ("Meerut", "India", "250001"),
-        ("Rajkot", "India", "360001"),
-        ("Kalyan-Dombivali", "India", "421201"),
-        ("Vasai-Virar", "India", "401201"),
-        ("Varanasi", "India", "221001")
-    ]
+    cities = INDIAN_CITIES
 
     statuses = [
         ShipmentStatus.PENDING,
@@ -412,7 +966,7 @@ def create_sample_shipments(session: Session):
         shipping_cost = round(weight * random.uniform(2, 8), 2)
 
         shipment = Shipment(
-            tracking_number=generate_tracking_number(),
+            tracking_number=generate_tracking_number(session),
             customer_id=customer.id,
             status=status,
             priority=priority,
@@ -438,7 +992,7 @@ def create_sample_shipments(session: Session):
             shipping_cost=shipping_cost,
             insurance_cost=round(declared_value * 0.01, 2) if random.choice([True, False]) else 0,
             total_cost=shipping_cost + (round(declared_value * 0.01, 2) if random.choice([True, False]) else 0),
-            current_location=f"{random.choice(cities)[0]} Distribution Center" if status in [ShipmentStatus.IN_TRANSIT, ShipmentStatus.OUT_FOR_DELIVERY] else None,
+            current_location=f"{random.choice(hub_network.path(hub_network.index[origin_city], hub_network.index[dest_city]))} Distribution Center" if status in [ShipmentStatus.IN_TRANSIT, ShipmentStatus.OUT_FOR_DELIVERY] else None,
             last_update=datetime.utcnow() - timedelta(hours=random.randint(1, 48))
         )
 
@@ -458,8 +1012,1100 @@ def create_sample_shipments(session: Session):
 
     session.commit()
 
+TERMINAL_STATUSES = [ShipmentStatus.DELIVERED, ShipmentStatus.RETURNED, ShipmentStatus.CANCELLED]
+
+def archive_terminal_shipments(session: Session, older_than_days: int = ARCHIVE_AFTER_DAYS,
+                               batch_size: int = ARCHIVE_BATCH_SIZE) -> Dict[str, int]:
+    """Move old delivered/returned/cancelled shipments and their events into the archive tables"""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived_shipments = 0
+    archived_events = 0
+    skipped_shipments = 0
+    last_id = 0
+
+    while True:
+        # Keyset over ids so rows skipped below can't wedge the loop on the same batch
+        batch = session.exec(
+            select(Shipment)
+            .where(Shipment.status.in_(TERMINAL_STATUSES), Shipment.last_update < cutoff, Shipment.id > last_id)
+            .order_by(Shipment.id)
+            .limit(batch_size)
+        ).all()
+        if not batch:
+            break
+        last_id = batch[-1].id
+
+        # Leave live any shipment whose id or tracking number is already archived (legacy reuse)
+        archived = session.exec(
+            select(ShipmentArchive.id, ShipmentArchive.tracking_number).where(or_(
+                ShipmentArchive.id.in_([s.id for s in batch]),
+                ShipmentArchive.tracking_number.in_([s.tracking_number for s in batch])
+            ))
+        ).all()
+        archived_ids = {row[0] for row in archived}
+        archived_numbers = {row[1] for row in archived}
+        shipments = [s for s in batch if s.id not in archived_ids and s.tracking_number not in archived_numbers]
+        skipped_shipments += len(batch) - len(shipments)
+        if not shipments:
+            continue
+
+        shipment_ids = [s.id for s in shipments]
+        events = session.exec(
+            select(TrackingEvent).where(TrackingEvent.shipment_id.in_(shipment_ids))
+        ).all()
+
+        # Copy the batch across, then drop it from the live tables in the same transaction
+        now = datetime.utcnow()
+        session.add_all([ShipmentArchive(**s.model_dump(), archived_at=now) for s in shipments])
+        session.add_all([TrackingEventArchive(**e.model_dump()) for e in events])
+        session.flush()
+        session.exec(delete(TrackingEvent).where(TrackingEvent.shipment_id.in_(shipment_ids)))
+        session.exec(delete(Shipment).where(Shipment.id.in_(shipment_ids)))
+        session.commit()
+        session.expunge_all()
+
+        archived_shipments += len(shipments)
+        archived_events += len(events)
+
+    return {
+        "archived_shipments": archived_shipments,
+        "archived_events": archived_events,
+        "skipped_shipments": skipped_shipments
+    }
+
+def _archive_once() -> Dict[str, int]:
+    with Session(engine) as session:
+        return archive_terminal_shipments(session)
+
+async def run_archiver():
+    """Periodically move old terminal shipments to the archive without blocking the event loop"""
+    while True:
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(None, _archive_once)
+            if result["archived_shipments"]:
+                print(f"📦 Archived {result['archived_shipments']} shipments and {result['archived_events']} events")
+        except Exception as e:
+            print(f"❌ Archiver error: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+def migrate_to_autoincrement(model, archive_model):
+    """Rebuild a live table created without AUTOINCREMENT and start its ids above every archived id"""
+    table = model.__table__
+    with engine.begin() as conn:
+        create_sql = conn.exec_driver_sql(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table.name,)
+        ).scalar()
+        if "AUTOINCREMENT" not in create_sql.upper():
+            # Legacy renames leave other tables' foreign keys pointing at the original name
+            conn.exec_driver_sql("PRAGMA legacy_alter_table = ON")
+            conn.exec_driver_sql(f'ALTER TABLE "{table.name}" RENAME TO "{table.name}_old"')
+            for index in table.indexes:
+                conn.exec_driver_sql(f'DROP INDEX IF EXISTS "{index.name}"')
+            table.create(conn)
+            columns = ", ".join(f'"{column.name}"' for column in table.columns)
+            conn.exec_driver_sql(f'INSERT INTO "{table.name}" ({columns}) SELECT {columns} FROM "{table.name}_old"')
+            conn.exec_driver_sql(f'DROP TABLE "{table.name}_old"')
+            conn.exec_driver_sql("PRAGMA legacy_alter_table = OFF")
+            print(f"✅ Rebuilt {table.name} with AUTOINCREMENT ids")
+
+        highest_archived = conn.execute(select(func.max(archive_model.id))).scalar() or 0
+        sequence = conn.exec_driver_sql(
+            "SELECT seq FROM sqlite_sequence WHERE name = ?", (table.name,)
+        ).scalar()
+        if sequence is None:
+            conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table.name, highest_archived))
+        elif sequence < highest_archived:
+            conn.exec_driver_sql("UPDATE sqlite_sequence SET seq = ? WHERE name = ?", (highest_archived, table.name))
+
+def find_shipment(db: Session, field: str, value):
+    """Look a shipment up in the live table, falling back to the archive.
+
+    Returns the shipment (or None) and the tracking event model that holds its events.
+    """
+    shipment = db.exec(select(Shipment).where(getattr(Shipment, field) == value)).first()
+    if shipment:
+        return shipment, TrackingEvent
+    shipment = db.exec(select(ShipmentArchive).where(getattr(ShipmentArchive, field) == value)).first()
+    return shipment, TrackingEventArchive
+
+def all_shipments(db: Session) -> list:
+    """Load every shipment, live and archived, for whole-history reporting"""
+    return list(db.exec(select(Shipment)).all()) + list(db.exec(select(ShipmentArchive)).all())
+
+# Fallback transit times when a lane has too little history
+DEFAULT_TRANSIT_DAYS = {
+    ShipmentPriority.URGENT: 2,
+    ShipmentPriority.HIGH: 3,
+    ShipmentPriority.NORMAL: 5,
+    ShipmentPriority.LOW: 7
+}
+
+def _grouped_percentile(sorted_values, starts, counts, q: float):
+    """Linear-interpolated percentile of each pre-sorted group in one vectorized step"""
+    position = starts + q * (counts - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+def compute_lane_summaries(origins, destinations, priorities, transit_days) -> List[Dict[str, Any]]:
+    """Summarize transit days per (origin, destination, priority) lane with NumPy"""
+    days = np.asarray(transit_days, dtype=np.float64)
+    if days.size == 0:
+        return []
+
+    # Dictionary-encode each key column and fold them into a single lane code
+    origin_values, origin_codes = np.unique(np.asarray(origins, dtype=object), return_inverse=True)
+    dest_values, dest_codes = np.unique(np.asarray(destinations, dtype=object), return_inverse=True)
+    priority_values, priority_codes = np.unique(np.asarray(priorities, dtype=object), return_inverse=True)
+    lane_codes = (origin_codes * len(dest_values) + dest_codes) * len(priority_values) + priority_codes
+
+    order = np.lexsort((days, lane_codes))
+    sorted_codes = lane_codes[order]
+    sorted_days = days[order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(sorted_codes)) + 1))
+    counts = np.diff(np.append(starts, sorted_days.size))
+
+    means = np.add.reduceat(sorted_days, starts) / counts
+    p50 = _grouped_percentile(sorted_days, starts, counts, 0.50)
+    p90 = _grouped_percentile(sorted_days, starts, counts, 0.90)
+    p95 = _grouped_percentile(sorted_days, starts, counts, 0.95)
+
+    lane_keys = sorted_codes[starts]
+    priority_idx = lane_keys % len(priority_values)
+    dest_idx = (lane_keys // len(priority_values)) % len(dest_values)
+    origin_idx = lane_keys // (len(priority_values) * len(dest_values))
+
+    return [
+        {
+            "origin_city": origin_values[origin_idx[i]],
+            "destination_city": dest_values[dest_idx[i]],
+            "priority": priority_values[priority_idx[i]],
+            "sample_count": int(counts[i]),
+            "mean_days": round(float(means[i]), 3),
+            "min_days": round(float(sorted_days[starts[i]]), 3),
+            "p50_days": round(float(p50[i]), 3),
+            "p90_days": round(float(p90[i]), 3),
+            "p95_days": round(float(p95[i]), 3),
+            "max_days": round(float(sorted_days[starts[i] + counts[i] - 1]), 3)
+        }
+        for i in range(len(starts))
+    ]
+
+def _delivered_transit_rows(session: Session, *criteria):
+    """Fetch (origin, destination, priority, transit days) for delivered shipments, live and archived"""
+    rows = []
+    for model in (Shipment, ShipmentArchive):
+        transit_days = func.julianday(model.actual_delivery_date) - func.julianday(model.created_at)
+        lane_criteria = [getattr(model, name) == value for name, value in criteria]
+        rows.extend(session.exec(
+            select(model.origin_city, model.destination_city, model.priority, transit_days)
+            .where(model.status == ShipmentStatus.DELIVERED, model.actual_delivery_date.is_not(None), *lane_criteria)
+        ).all())
+    return rows
+
+def refresh_lane_stats(session: Session, origin_city: Optional[str] = None,
+                       destination_city: Optional[str] = None,
+                       priority: Optional[ShipmentPriority] = None) -> int:
+    """Recompute lane statistics, either for one lane or for every lane"""
+    criteria = []
+    if origin_city is not None:
+        criteria = [("origin_city", origin_city), ("destination_city", destination_city), ("priority", priority)]
+    else:
+        session.exec(delete(LaneStats))
+
+    rows = _delivered_transit_rows(session, *criteria)
+    summaries = compute_lane_summaries(
+        [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows], [r[3] for r in rows]
+    )
+
+    now = datetime.utcnow()
+    for summary in summaries:
+        session.merge(LaneStats(**summary, updated_at=now))
+    session.commit()
+    return len(summaries)
+
+def refresh_lane_stats_task(origin_city: str, destination_city: str, priority: ShipmentPriority):
+    """Background-task entry point: refresh one lane in its own session, after the response is sent"""
+    with Session(engine) as session:
+        refresh_lane_stats(session, origin_city, destination_city, priority)
+
+def estimate_transit_days(session: Session, origin_city: str, destination_city: str,
+                          priority: ShipmentPriority):
+    """Return (transit days, source, lane stats) for a lane"""
+    stats = session.get(LaneStats, (origin_city, destination_city, priority))
+    if stats and stats.sample_count >= LANE_STATS_MIN_SAMPLES:
+        return math.ceil(getattr(stats, LANE_ETA_PERCENTILE)), "lane_stats", stats
+    return DEFAULT_TRANSIT_DAYS[priority], "default", stats
+
+# Active rate card used by every pricing path
+rate_card = RateCard()
+
+def parse_dimensions(dimensions: str) -> float:
+    """Volume in cm³ of an "LxWxH" string; raises ValueError unless all three are finite and positive"""
+    parts = dimensions.lower().split("x")
+    try:
+        sides = [float(part) for part in parts]
+    except ValueError:
+        sides = []
+    if len(sides) != 3 or not all(math.isfinite(side) and side > 0 for side in sides):
+        raise ValueError(f"dimensions must be three positive numbers as LxWxH, got {dimensions!r}")
+    return sides[0] * sides[1] * sides[2]
+
+def _parse_dimensions(dimensions: Optional[str]) -> float:
+    """Volume of stored dimensions, or 0 when they are missing or invalid"""
+    try:
+        return parse_dimensions(dimensions)
+    except (AttributeError, ValueError):
+        return 0.0
+
+def quote_shipments(origins, destinations, weights, dimensions, priorities,
+                    declared_values, insurance_required, card: Optional[RateCard] = None) -> Dict[str, Any]:
+    """Price a batch of shipments at once; every argument is a same-length sequence"""
+    card = card or rate_card
+    weights = np.asarray(weights, dtype=np.float64)
+    declared = np.asarray([v or 0.0 for v in declared_values], dtype=np.float64)
+    insured = np.asarray(insurance_required, dtype=bool)
+
+    # Parse each distinct dimensions string once, then broadcast back to the rows
+    dim_values, dim_codes = np.unique(np.asarray([d or "" for d in dimensions], dtype=object), return_inverse=True)
+    volumes = np.array([_parse_dimensions(d) for d in dim_values], dtype=np.float64)[dim_codes]
+    chargeable_weight = np.maximum(weights, volumes / card.dim_divisor)
+
+    priority_values, priority_codes = np.unique(np.asarray(priorities, dtype=object), return_inverse=True)
+    priority_factor = np.array([card.priority_multipliers.get(p, 1.0) for p in priority_values])[priority_codes]
+
+    lane_factor = np.ones(weights.size)
+    if card.lane_multipliers:
+        lanes = np.char.add(np.char.add(np.asarray(origins, dtype=str), "->"), np.asarray(destinations, dtype=str))
+        lane_values, lane_codes = np.unique(lanes, return_inverse=True)
+        lane_factor = np.array([card.lane_multipliers.get(l, 1.0) for l in lane_values])[lane_codes]
+
+    shipping_cost = np.round((card.base_cost + chargeable_weight * card.rate_per_kg) * priority_factor * lane_factor, 2)
+    insurance_cost = np.round(np.where(insured, declared * card.insurance_rate, 0.0), 2)
+
+    return {
+        "chargeable_weight": np.round(chargeable_weight, 2),
+        "shipping_cost": shipping_cost,
+        "insurance_cost": insurance_cost,
+        "total_cost": np.round(shipping_cost + insurance_cost, 2)
+    }
+
+# Delivery-time sketches use log-spaced buckets, so any percentile is within ~2.5% of the true value,
+# plus an exact fixed-bucket histogram by whole days
+SKETCH_GAMMA = 1.05
+SKETCH_LOG_GAMMA = math.log(SKETCH_GAMMA)
+HISTOGRAM_DAY_EDGES = [1, 2, 3, 4, 5, 6, 7, 10, 14, 21, 30]
+sketch_lock = threading.Lock()
+
+class DeliveryTimeSketch:
+    """Log-bucketed histogram of delivery hours that can be merged and persisted"""
+
+    def __init__(self, row: Optional[DeliverySketch] = None):
+        self.row = row
+        self.count = row.count if row else 0
+        self.total_hours = row.total_hours if row else 0.0
+        self.min_hours = row.min_hours if row else None
+        self.max_hours = row.max_hours if row else None
+        self.buckets = {int(k): v for k, v in json.loads(row.buckets).items()} if row else {}
+        self.day_counts = (json.loads(row.day_histogram) if row else []) or [0] * (len(HISTOGRAM_DAY_EDGES) + 1)
+
+    @staticmethod
+    def bucket_index(hours: float) -> int:
+        return 0 if hours <= 1 else math.ceil(math.log(hours) / SKETCH_LOG_GAMMA)
+
+    @staticmethod
+    def bucket_value(index: int) -> float:
+        """Representative hours for a bucket (midpoint in log space)"""
+        if index <= 0:
+            return 1.0
+        return 2 * SKETCH_GAMMA ** index / (SKETCH_GAMMA + 1)
+
+    def add(self, hours: float):
+        hours = max(hours, 0.0)
+        index = self.bucket_index(hours)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.day_counts[bisect.bisect_right(HISTOGRAM_DAY_EDGES, hours / 24)] += 1
+        self.count += 1
+        self.total_hours += hours
+        self.min_hours = hours if self.min_hours is None else min(self.min_hours, hours)
+        self.max_hours = hours if self.max_hours is None else max(self.max_hours, hours)
+
+    def merge(self, other: "DeliveryTimeSketch"):
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+        self.day_counts = [a + b for a, b in zip(self.day_counts, other.day_counts)]
+        self.count += other.count
+        self.total_hours += other.total_hours
+        if other.count:
+            self.min_hours = other.min_hours if self.min_hours is None else min(self.min_hours, other.min_hours)
+            self.max_hours = other.max_hours if self.max_hours is None else max(self.max_hours, other.max_hours)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                return min(max(self.bucket_value(index), self.min_hours), self.max_hours)
+        return self.max_hours
+
+    def histogram(self) -> List[Dict[str, Any]]:
+        """Counts per day range, using HISTOGRAM_DAY_EDGES as upper bounds"""
+        lower_edges = [0] + HISTOGRAM_DAY_EDGES
+        upper_edges = HISTOGRAM_DAY_EDGES + [None]
+        return [
+            {"from_days": lower, "to_days": upper, "count": count}
+            for lower, upper, count in zip(lower_edges, upper_edges, self.day_counts)
+        ]
+
+    def summary(self) -> Dict[str, Any]:
+        def hours(value):
+            return round(value, 2) if value is not None else None
+        return {
+            "count": self.count,
+            "mean_hours": hours(self.total_hours / self.count) if self.count else None,
+            "min_hours": hours(self.min_hours),
+            "p50_hours": hours(self.quantile(0.50)),
+            "p90_hours": hours(self.quantile(0.90)),
+            "p99_hours": hours(self.quantile(0.99)),
+            "max_hours": hours(self.max_hours),
+            "histogram": self.histogram()
+        }
+
+    def to_row(self, dimension: str, key: str) -> DeliverySketch:
+        row = self.row or DeliverySketch(dimension=dimension, key=key)
+        row.count = self.count
+        row.total_hours = self.total_hours
+        row.min_hours = self.min_hours
+        row.max_hours = self.max_hours
+        row.buckets = json.dumps(self.buckets)
+        row.day_histogram = json.dumps(self.day_counts)
+        row.updated_at = datetime.utcnow()
+        return row
+
+def _fold_delivery(sketches: Dict[tuple, DeliveryTimeSketch], session: Optional[Session], priority: ShipmentPriority,
+                   origin_city: str, destination_city: str, created_at: datetime, delivered_at: datetime):
+    """Add one delivery to every sketch it belongs to, loading persisted sketches through session if given"""
+    hours = (delivered_at - created_at).total_seconds() / 3600
+    for dimension, key in (
+        ("all", "all"),
+        ("priority", priority.value),
+        ("lane", f"{origin_city}->{destination_city}"),
+        ("month", delivered_at.strftime("%Y-%m"))
+    ):
+        sketch = sketches.get((dimension, key))
+        if sketch is None:
+            sketch = sketches[(dimension, key)] = DeliveryTimeSketch(
+                session.get(DeliverySketch, (dimension, key)) if session else None
+            )
+        sketch.add(hours)
+
+def record_delivery(session: Session, shipment: Shipment):
+    """Stage a newly delivered shipment into the persisted sketches.
+
+    The caller holds sketch_lock and commits, so the sketches change in the same transaction as the shipment.
+    """
+    if not shipment.actual_delivery_date or not shipment.created_at:
+        return
+    sketches: Dict[tuple, DeliveryTimeSketch] = {}
+    _fold_delivery(
+        sketches, session, shipment.priority, shipment.origin_city, shipment.destination_city,
+        shipment.created_at, shipment.actual_delivery_date
+    )
+    for (dimension, key), sketch in sketches.items():
+        session.add(sketch.to_row(dimension, key))
+
+def rebuild_delivery_sketches(session: Session) -> int:
+    """Replace the persisted sketches with a single pass over the full delivered history"""
+    with sketch_lock:
+        session.exec(delete(DeliverySketch))
+        sketches: Dict[tuple, DeliveryTimeSketch] = {}
+        folded = 0
+
+        for model in (Shipment, ShipmentArchive):
+            query = select(
+                model.priority, model.origin_city, model.destination_city,
+                model.created_at, model.actual_delivery_date
+            ).where(model.status == ShipmentStatus.DELIVERED, model.actual_delivery_date.is_not(None))
+            for priority, origin, destination, created_at, delivered_at in session.exec(query):
+                _fold_delivery(sketches, None, priority, origin, destination, created_at, delivered_at)
+                folded += 1
+
+        for (dimension, key), sketch in sketches.items():
+            session.add(sketch.to_row(dimension, key))
+        session.commit()
+        return folded
+
+class NotificationHub:
+    """Wakes long-polling inbox requests when a user gets a new notification"""
+
+    def __init__(self):
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.waiters: Dict[int, List[asyncio.Event]] = {}
+
+    def subscribe(self, user_id: int) -> asyncio.Event:
+        event = asyncio.Event()
+        self.waiters.setdefault(user_id, []).append(event)
+        return event
+
+    def unsubscribe(self, user_id: int, event: asyncio.Event):
+        events = self.waiters.get(user_id, [])
+        if event in events:
+            events.remove(event)
+        if not events:
+            self.waiters.pop(user_id, None)
+
+    def _wake(self, user_ids):
+        for user_id in user_ids:
+            for event in self.waiters.get(user_id, []):
+                event.set()
+
+    def publish(self, user_ids):
+        """Safe to call from worker threads as well as the event loop"""
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._wake, set(user_ids))
+
+notification_hub = NotificationHub()
+
+def add_notifications(session: Session, notifications: List[Notification]):
+    """Stage notifications and bump unread counters; the caller commits and then publishes"""
+    session.add_all(notifications)
+    per_user: Dict[int, int] = {}
+    for notification in notifications:
+        if notification.user_id is not None:
+            per_user[notification.user_id] = per_user.get(notification.user_id, 0) + 1
+    for user_id, count in per_user.items():
+        session.exec(
+            sqlite_insert(NotificationCounter)
+            .values(user_id=user_id, unread=count)
+            .on_conflict_do_update(index_elements=["user_id"], set_={"unread": NotificationCounter.unread + count})
+        )
+    return list(per_user)
+
+def rebuild_notification_counters(session: Session):
+    """Recount unread notifications per user from the inbox index"""
+    session.exec(delete(NotificationCounter))
+    counts = session.exec(
+        select(Notification.user_id, func.count())
+        .where(Notification.user_id.is_not(None), Notification.read == False)
+        .group_by(Notification.user_id)
+    ).all()
+    session.add_all([NotificationCounter(user_id=user_id, unread=count) for user_id, count in counts])
+    session.commit()
+
+OPEN_STATUSES = [s for s in ShipmentStatus if s not in TERMINAL_STATUSES]
+
+class ShipmentIndex:
+    """Column store of active (non-terminal) shipments for status-board queries.
+
+    Cities, statuses and priorities are dictionary-encoded into small integer
+    arrays, so a filtered count or group-by is a handful of vectorized mask
+    operations. Rows stay sorted by id, so finding a shipment is a binary
+    search over the id column rather than a per-row Python dict. Removed rows
+    are tombstoned and compacted away in bulk.
+    """
+
+    COLUMNS = {
+        "id": np.int64,
+        "live": np.bool_,
+        "origin_city": np.int32,
+        "destination_city": np.int32,
+        "status": np.int8,
+        "priority": np.int8,
+        "customer_id": np.int32
+    }
+    COMPACT_FRACTION = 0.25  # compact once this share of rows are tombstones
+
+    def __init__(self, capacity: int = 1024):
+        self.lock = threading.RLock()
+        self._reset(capacity)
+
+    def _reset(self, capacity: int):
+        self.size = 0  # rows in use, tombstones included
+        self.dead = 0
+        self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        self.cities: List[str] = []
+        self.city_codes: Dict[str, int] = {}
+        self.statuses = list(ShipmentStatus)
+        self.status_codes = {status: i for i, status in enumerate(self.statuses)}
+        self.priorities = list(ShipmentPriority)
+        self.priority_codes = {priority: i for i, priority in enumerate(self.priorities)}
+        self.loaded = False
+
+    @property
+    def live_rows(self) -> int:
+        return self.size - self.dead
+
+    def _city_code(self, city: str) -> int:
+        code = self.city_codes.get(city)
+        if code is None:
+            code = self.city_codes[city] = len(self.cities)
+            self.cities.append(city)
+        return code
+
+    def _grow(self):
+        for name, column in self.columns.items():
+            grown = np.zeros(len(column) * 2, dtype=column.dtype)
+            grown[:self.size] = column[:self.size]
+            self.columns[name] = grown
+
+    def _find(self, shipment_id: int) -> tuple:
+        """(position, found) of an id in the sorted id column"""
+        ids = self.columns["id"][:self.size]
+        position = int(np.searchsorted(ids, shipment_id))
+        return position, position < self.size and ids[position] == shipment_id
+
+    def _insert_at(self, position: int):
+        if self.size == len(self.columns["id"]):
+            self._grow()
+        # Ids are assigned in increasing order, so this is almost always an append
+        if position < self.size:
+            for column in self.columns.values():
+                column[position + 1:self.size + 1] = column[position:self.size]
+        self.size += 1
+
+    def _compact(self):
+        keep = self.columns["live"][:self.size].copy()
+        kept = int(np.count_nonzero(keep))
+        for column in self.columns.values():
+            column[:kept] = column[:self.size][keep]
+        self.size = kept
+        self.dead = 0
+
+    def upsert(self, shipment_id: int, origin_city: str, destination_city: str,
+               status: ShipmentStatus, priority: ShipmentPriority, customer_id: Optional[int]):
+        """Insert or refresh a shipment; terminal statuses drop it from the index"""
+        with self.lock:
+            if status not in OPEN_STATUSES:
+                self.remove(shipment_id)
+                return
+            position, found = self._find(shipment_id)
+            if not found:
+                self._insert_at(position)
+            elif not self.columns["live"][position]:
+                self.dead -= 1
+            row = {
+                "id": shipment_id,
+                "live": True,
+                "origin_city": self._city_code(origin_city),
+                "destination_city": self._city_code(destination_city),
+                "status": self.status_codes[status],
+                "priority": self.priority_codes[priority],
+                "customer_id": customer_id if customer_id is not None else -1
+            }
+            for name, value in row.items():
+                self.columns[name][position] = value
+
+    def remove(self, shipment_id: int):
+        with self.lock:
+            position, found = self._find(shipment_id)
+            if not found or not self.columns["live"][position]:
+                return
+            self.columns["live"][position] = False
+            self.dead += 1
+            if self.dead > self.size * self.COMPACT_FRACTION:
+                self._compact()
+
+    def load(self, session: Session):
+        with self.lock:
+            self._reset(1024)
+            rows = session.exec(
+                select(Shipment.id, Shipment.origin_city, Shipment.destination_city,
+                       Shipment.status, Shipment.priority, Shipment.customer_id)
+                .where(Shipment.status.in_(OPEN_STATUSES))
+                .order_by(Shipment.id)
+            )
+            for row in rows:
+                self.upsert(*row)
+            self.loaded = True
+
+    def _mask(self, status=None, priority=None, origin_city=None, destination_city=None, customer_id=None):
+        """Boolean mask over the live rows; a city the index has never seen matches nothing (code -1)"""
+        mask = self.columns["live"][:self.size].copy()
+        filters = [
+            ("status", None if status is None else self.status_codes.get(status)),
+            ("priority", None if priority is None else self.priority_codes.get(priority)),
+            ("origin_city", None if origin_city is None else self.city_codes.get(origin_city, -1)),
+            ("destination_city", None if destination_city is None else self.city_codes.get(destination_city, -1)),
+            ("customer_id", customer_id)
+        ]
+        for name, code in filters:
+            if code is not None:
+                mask &= self.columns[name][:self.size] == code
+        return mask
+
+    def count(self, **filters) -> int:
+        with self.lock:
+            return int(np.count_nonzero(self._mask(**filters)))
+
+    def group_by(self, field: str, **filters) -> Dict[str, int]:
+        labels = {
+            "status": lambda: [s.value for s in self.statuses],
+            "priority": lambda: [p.value for p in self.priorities],
+            "origin_city": lambda: self.cities,
+            "destination_city": lambda: self.cities
+        }[field]
+        with self.lock:
+            names = labels()
+            codes = self.columns[field][:self.size][self._mask(**filters)]
+            counts = np.bincount(codes, minlength=len(names))
+            return {names[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+    def memory_stats(self) -> Dict[str, Any]:
+        """Measured sizes; the id column doubles as the lookup structure, so there is no separate id map"""
+        with self.lock:
+            bytes_per_row = sum(np.dtype(dtype).itemsize for dtype in self.COLUMNS.values())
+            city_dictionary_bytes = (
+                sys.getsizeof(self.cities) + sys.getsizeof(self.city_codes)
+                + sum(sys.getsizeof(city) for city in self.cities)
+            )
+            return {
+                "rows": self.live_rows,
+                "tombstones": self.dead,
+                "capacity": len(self.columns["id"]),
+                "distinct_cities": len(self.cities),
+                "column_bytes": sum(column.nbytes for column in self.columns.values()),
+                "column_bytes_per_row": bytes_per_row,
+                "column_mb_per_million_rows": round(bytes_per_row * 1_000_000 / 2 ** 20, 1),
+                "city_dictionary_bytes": city_dictionary_bytes
+            }
+
+shipment_index = ShipmentIndex()
+
+# Keep the index in step with ORM writes, applying them only once they commit
+@event.listens_for(OrmSession, "after_flush")
+def track_shipment_index_changes(session, flush_context):
+    if not SHIPMENT_INDEX_ENABLED:
+        return
+    changes = session.info.setdefault("shipment_index_changes", [])
+    for instance in list(session.new) + list(session.dirty):
+        if isinstance(instance, Shipment):
+            changes.append(("upsert", (instance.id, instance.origin_city, instance.destination_city,
+                                       instance.status, instance.priority, instance.customer_id)))
+    for instance in session.deleted:
+        if isinstance(instance, Shipment):
+            changes.append(("remove", (instance.id,)))
+
+@event.listens_for(OrmSession, "after_commit")
+def apply_shipment_index_changes(session):
+    for operation, args in session.info.pop("shipment_index_changes", []):
+        getattr(shipment_index, operation)(*args)
+
+@event.listens_for(OrmSession, "after_rollback")
+def forget_shipment_index_changes(session):
+    session.info.pop("shipment_index_changes", None)
+
+SLA_ALERT_ROLES = [UserRole.ADMIN, UserRole.MANAGER]
+sla_scan_lock = threading.Lock()
+
+def scan_sla_breaches(session: Session, batch_size: int = SLA_SCAN_BATCH_SIZE) -> int:
+    """Notify staff about open shipments whose estimated delivery date has passed since the last scan"""
+    with sla_scan_lock:
+        return _scan_sla_breaches(session, batch_size)
+
+def _scan_sla_breaches(session: Session, batch_size: int) -> int:
+    watermark = session.get(ScanWatermark, "sla_breaches") or ScanWatermark(name="sla_breaches")
+    recipients = session.exec(
+        select(User.id).where(User.role.in_(SLA_ALERT_ROLES), User.is_active == True)
+    ).all()
+    today = date.today()
+    breaches = 0
+
+    while True:
+        query = (
+            select(Shipment.id, Shipment.tracking_number, Shipment.estimated_delivery_date, Shipment.status)
+            .where(Shipment.status.in_(OPEN_STATUSES), Shipment.estimated_delivery_date < today)
+            .order_by(Shipment.estimated_delivery_date, Shipment.id)
+            .limit(batch_size)
+        )
+        if watermark.last_timestamp:
+            last_date = watermark.last_timestamp.date()
+            query = query.where(or_(
+                Shipment.estimated_delivery_date > last_date,
+                and_(Shipment.estimated_delivery_date == last_date, Shipment.id > watermark.last_id)
+            ))
+        rows = session.exec(query).all()
+        if not rows:
+            break
+
+        now = datetime.utcnow()
+        notified = add_notifications(session, [
+            Notification(
+                user_id=user_id,
+                title="SLA breach",
+                message=f"Shipment {tracking_number} is {status.value.replace('_', ' ')} and was due on {due.isoformat()}",
+                type="warning",
+                created_at=now
+            )
+            for _, tracking_number, due, status in rows
+            for user_id in recipients
+        ])
+
+        # Advance the watermark in the same transaction as the notifications
+        last_id, _, last_due, _ = rows[-1]
+        watermark.last_timestamp = datetime.combine(last_due, datetime.min.time())
+        watermark.last_id = last_id
+        watermark.updated_at = now
+        session.add(watermark)
+        session.commit()
+        notification_hub.publish(notified)
+        breaches += len(rows)
+
+    return breaches
+
+def _scan_sla_breaches_once() -> int:
+    with Session(engine) as session:
+        return scan_sla_breaches(session)
+
+async def run_sla_scanner():
+    """Periodically sweep for SLA breaches without blocking the event loop"""
+    while True:
+        try:
+            breaches = await asyncio.get_running_loop().run_in_executor(None, _scan_sla_breaches_once)
+            if breaches:
+                print(f"⚠️ SLA scanner found {breaches} new breaches")
+        except Exception as e:
+            print(f"❌ SLA scanner error: {e}")
+        await asyncio.sleep(SLA_SCAN_INTERVAL_SECONDS)
+
+# First match wins; paths matching nothing use DEFAULT_ROUTE_LIMIT
+ROUTE_LIMITS = [
+    RouteLimit(pattern=r"^/(health|docs|redoc|openapi\.json)$", rate=0, burst=0),
+    RouteLimit(pattern=r"^/notifications/poll$", methods=["GET"], rate=1, burst=5),
+    RouteLimit(pattern=r"^/shipments$", methods=["GET"], rate=5, burst=10, heavy=True),
+    RouteLimit(pattern=r"^/customers$", methods=["GET"], rate=5, burst=10, heavy=True),
+    RouteLimit(pattern=r"^/analytics/", methods=["GET"], rate=2, burst=5, heavy=True),
+    RouteLimit(pattern=r"^/quotes/batch$", methods=["POST"], rate=2, burst=5, heavy=True),
+    RouteLimit(pattern=r"^/routes/batch$", methods=["POST"], rate=2, burst=5, heavy=True),
+    RouteLimit(pattern=r"^/token$", methods=["POST"], rate=1, burst=5),
+]
+DEFAULT_ROUTE_LIMIT = RouteLimit(pattern=".*", rate=20, burst=40)
+
+class AdmissionController:
+    """Per-client token buckets plus a global cap on in-flight heavy requests.
+
+    Runs on the event loop only, so no locking is needed.
+    """
+
+    def __init__(self, limits: List[RouteLimit], default: RouteLimit):
+        self.limits = [(re.compile(limit.pattern), limit) for limit in limits]
+        self.default = default
+        self.buckets: "OrderedDict[tuple, List[float]]" = OrderedDict()
+        self.heavy_in_flight = 0
+        self.heavy_queued = 0
+        self.heavy_slots: Optional[asyncio.Semaphore] = None  # created on the serving loop
+        self.metrics: Dict[str, Dict[str, int]] = {}
+
+    def match(self, method: str, path: str) -> tuple:
+        for regex, limit in self.limits:
+            if method in limit.methods and regex.match(path):
+                return limit.pattern, limit
+        return "default", self.default
+
+    def count(self, route: str, outcome: str):
+        route_metrics = self.metrics.setdefault(route, {"allowed": 0, "rate_limited": 0, "shed": 0})
+        route_metrics[outcome] += 1
+
+    def take(self, key: tuple, limit: RouteLimit) -> float:
+        """Take one token; returns 0 on success or the seconds until a token is available"""
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [float(limit.burst), now]
+            # Least recently used clients go first; an evicted client just starts with a full bucket
+            while len(self.buckets) > RATE_LIMIT_MAX_CLIENTS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        tokens = min(limit.burst, bucket[0] + (now - bucket[1]) * limit.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / limit.rate
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "heavy_in_flight": self.heavy_in_flight,
+            "heavy_queued": self.heavy_queued,
+            "heavy_max_in_flight": HEAVY_MAX_IN_FLIGHT,
+            "heavy_max_queue": HEAVY_MAX_QUEUE,
+            "tracked_clients": len(self.buckets),
+            "routes": self.metrics
+        }
+
+admission = AdmissionController(ROUTE_LIMITS, DEFAULT_ROUTE_LIMIT)
+
+def _reject(status_code: int, detail: str, retry_after: float) -> JSONResponse:
+    return JSONResponse(
+        status_code=status_code,
+        content={"detail": detail},
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+    )
+
+# Per-request diagnostics state: route label, plus query list and profiler when profiling
+request_diagnostics: ContextVar[Optional[Dict[str, Any]]] = ContextVar("request_diagnostics", default=None)
+
+def before_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+def after_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed_ms = (time.perf_counter() - conn.info["query_started"].pop()) * 1000
+    diagnostics = request_diagnostics.get()
+    route = diagnostics["route"] if diagnostics else "background"
+    # sqlite3 reports -1 for SELECTs, since rows are only counted as they're fetched
+    rowcount = cursor.rowcount if cursor.rowcount >= 0 else None
+
+    if diagnostics and diagnostics.get("queries") is not None:
+        diagnostics["db_ms"] += elapsed_ms
+        diagnostics["queries"].append({
+            "statement": statement,
+            "parameters": repr(parameters),
+            "duration_ms": round(elapsed_ms, 3),
+            "rowcount": rowcount
+        })
+
+    if SLOW_QUERY_THRESHOLD_MS and elapsed_ms >= SLOW_QUERY_THRESHOLD_MS:
+        print(f"🐢 Slow query ({elapsed_ms:.1f} ms, rows={rowcount}) in {route}: {statement} {parameters!r}")
+
+def install_query_hooks(target_engine):
+    if SLOW_QUERY_THRESHOLD_MS or REQUEST_PROFILING_ENABLED:
+        event.listen(target_engine, "before_cursor_execute", before_query)
+        event.listen(target_engine, "after_cursor_execute", after_query)
+
+install_query_hooks(engine)
+
+class AnalyticsSnapshot:
+    """Read-only copy of the live database made with SQLite's online backup API.
+
+    Two snapshot files are used in turn, so a refresh never overwrites the
+    file that current analytics reads are using.
+    """
+
+    def __init__(self, source_engine):
+        base, _ = os.path.splitext(source_engine.url.database)
+        self.source_engine = source_engine
+        self.paths = [f"{base}.analytics-a.db", f"{base}.analytics-b.db"]
+        self.engines: List[Optional[Any]] = [None, None]
+        self.active: Optional[int] = None
+        self.taken_at: Optional[datetime] = None
+        self.last_duration_ms: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            target = 1 if self.active == 0 else 0
+            taken_at = datetime.utcnow()
+            started = time.perf_counter()
+
+            source = self.source_engine.raw_connection()
+            try:
+                destination = sqlite3.connect(self.paths[target])
+                try:
+                    # One step copies a consistent snapshot; with WAL, writers keep going meanwhile
+                    source.driver_connection.backup(destination)
+                    # Rollback journal, so read-only connections don't need to create -wal/-shm files
+                    destination.execute("PRAGMA journal_mode=DELETE")
+                finally:
+                    destination.close()
+            finally:
+                source.close()
+
+            if self.engines[target] is None:
+                self.engines[target] = create_engine(
+                    f"sqlite:///file:{self.paths[target]}?mode=ro&uri=true", echo=False
+                )
+                install_query_hooks(self.engines[target])
+            else:
+                self.engines[target].dispose()
+
+            self.active = target
+            self.taken_at = taken_at
+            self.last_duration_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    @property
+    def engine(self):
+        return self.engines[self.active] if self.active is not None else None
+
+    def age_seconds(self) -> Optional[float]:
+        return round((datetime.utcnow() - self.taken_at).total_seconds(), 1) if self.taken_at else None
+
+analytics_snapshot = AnalyticsSnapshot(engine)
+
+def _active_profile() -> Optional[Dict[str, Any]]:
+    diagnostics = request_diagnostics.get()
+    return diagnostics if diagnostics and diagnostics.get("profiler") else None
+
+def _finish_profile(diagnostics: Dict[str, Any], started: float):
+    diagnostics["profiler"].disable()
+    diagnostics["handler_done"] = time.perf_counter()
+    diagnostics["handler_ms"] += (diagnostics["handler_done"] - started) * 1000
+
+class ProfiledRoute(APIRoute):
+    """Route that runs its endpoint under the request's profiler when one is active"""
+
+    def __init__(self, path: str, endpoint, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def profiled_endpoint(*args, **kw):
+                diagnostics = _active_profile()
+                if not diagnostics:
+                    return await endpoint(*args, **kw)
+                started = time.perf_counter()
+                diagnostics["profiler"].enable()
+                try:
+                    return await endpoint(*args, **kw)
+                finally:
+                    _finish_profile(diagnostics, started)
+        else:
+            @functools.wraps(endpoint)
+            def profiled_endpoint(*args, **kw):
+                diagnostics = _active_profile()
+                if not diagnostics:
+                    return endpoint(*args, **kw)
+                started = time.perf_counter()
+                diagnostics["profiler"].enable()
+                try:
+                    return endpoint(*args, **kw)
+                finally:
+                    _finish_profile(diagnostics, started)
+        super().__init__(path, profiled_endpoint, **kwargs)
+
+def _profile_requested(request: Request) -> bool:
+    return request.headers.get("x-profile") == "1" or request.query_params.get("profile") == "1"
+
+def _token_user_id(authorization: str) -> Optional[int]:
+    """User id of a verified bearer token, or None; junk headers must not mint rate-limit buckets"""
+    if not authorization.lower().startswith("bearer "):
+        return None
+    try:
+        return get_current_user_id(authorization[7:])
+    except HTTPException:
+        return None
+
+def _is_admin_request(request: Request) -> bool:
+    authorization = request.headers.get("authorization", "")
+    if not authorization.lower().startswith("bearer "):
+        return False
+    try:
+        principal = get_current_principal(get_current_user_id(authorization[7:]))
+    except HTTPException:
+        return False
+    return principal.role == UserRole.ADMIN
+
+def _profile_top(profiler: cProfile.Profile) -> List[Dict[str, Any]]:
+    try:
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+    except TypeError:
+        # Nothing ran under the profiler (e.g. a 304, or a dependency raised first)
+        return []
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP_N]
+    return [
+        {
+            "function": f"{filename}:{line}({name})",
+            "calls": calls,
+            "total_ms": round(total_time * 1000, 3),
+            "cumulative_ms": round(cumulative_time * 1000, 3)
+        }
+        for (filename, line, name), (_, calls, total_time, cumulative_time, _) in rows
+    ]
+
 # Create app
 app = FastAPI(title="Working Shipment API", version="1.0.0")
+if REQUEST_PROFILING_ENABLED:
+    app.router.route_class = ProfiledRoute
+
+# Innermost, so gzip sees whole response bodies and can honour the size threshold
+app.add_middleware(GZipMiddleware, minimum_size=GZIP_MINIMUM_SIZE)
+
+# Registered before CORS so rejections still carry CORS headers
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    route, limit = admission.match(request.method, request.url.path)
+    if not RATE_LIMIT_ENABLED or request.method == "OPTIONS" or limit.rate <= 0:
+        return await call_next(request)
+
+    # Check the per-IP bucket and then, for verified tokens only, the per-user bucket
+    retry_after = admission.take(("ip", request.client.host if request.client else "unknown", route), limit)
+    if not retry_after:
+        user_id = _token_user_id(request.headers.get("authorization", ""))
+        if user_id is not None:
+            retry_after = admission.take(("user", user_id, route), limit)
+    if retry_after:
+        admission.count(route, "rate_limited")
+        return _reject(429, "Rate limit exceeded", retry_after)
+
+    if not limit.heavy:
+        admission.count(route, "allowed")
+        return await call_next(request)
+
+    # Heavy routes share a global in-flight cap; shed fast once the wait queue is full
+    if admission.heavy_slots is None:
+        admission.heavy_slots = asyncio.Semaphore(HEAVY_MAX_IN_FLIGHT)
+    if admission.heavy_slots.locked() and admission.heavy_queued >= HEAVY_MAX_QUEUE:
+        admission.count(route, "shed")
+        return _reject(503, "Server busy, please retry", 1)
+    admission.heavy_queued += 1
+    try:
+        await asyncio.wait_for(admission.heavy_slots.acquire(), HEAVY_QUEUE_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        admission.count(route, "shed")
+        return _reject(503, "Server busy, please retry", 1)
+    finally:
+        admission.heavy_queued -= 1
+
+    admission.count(route, "allowed")
+    admission.heavy_in_flight += 1
+    try:
+        return await call_next(request)
+    finally:
+        admission.heavy_in_flight -= 1
+        admission.heavy_slots.release()
+
+async def request_diagnostics_middleware(request: Request, call_next):
+    diagnostics = {"route": f"{request.method} {request.url.path}"}
+    profiling = REQUEST_PROFILING_ENABLED and _profile_requested(request) and _is_admin_request(request)
+    if profiling:
+        diagnostics.update(queries=[], db_ms=0.0, handler_ms=0.0, handler_done=None, profiler=cProfile.Profile())
+    request_diagnostics.set(diagnostics)
+
+    started = time.perf_counter()
+    response = await call_next(request)
+    if not profiling or response.status_code == 304:
+        # A 304 must not carry a body, so it cannot be wrapped in a profile
+        return response
+
+    response_ready = time.perf_counter()
+    body = b"".join([chunk async for chunk in response.body_iterator])
+    if response.headers.get("content-encoding") == "gzip":
+        body = gzip.decompress(body)
+    try:
+        payload = json.loads(body) if body else None
+    except ValueError:
+        payload = body.decode(errors="replace")
+
+    serialization_ms = (response_ready - diagnostics["handler_done"]) * 1000 if diagnostics["handler_done"] else None
+    profile = {
+        "route": diagnostics["route"],
+        "total_ms": round((response_ready - started) * 1000, 3),
+        "handler_ms": round(diagnostics["handler_ms"], 3),
+        "db_ms": round(diagnostics["db_ms"], 3),
+        "serialization_ms": round(serialization_ms, 3) if serialization_ms is not None else None,
+        "query_count": len(diagnostics["queries"]),
+        "queries": diagnostics["queries"],
+        "top_functions": _profile_top(diagnostics["profiler"])
+    }
+    return JSONResponse(
+        status_code=response.status_code,
+        content={"profile": profile, "response": payload},
+        headers={"Server-Timing": f'db;dur={profile["db_ms"]}, total;dur={profile["total_ms"]}'}
+    )
+
+if SLOW_QUERY_THRESHOLD_MS or REQUEST_PROFILING_ENABLED:
+    app.middleware("http")(request_diagnostics_middleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -474,10 +2120,57 @@ def get_db():
     with Session(engine) as session:
         yield session
 
+def get_analytics_db(response: Response, live: bool = False):
+    """Session on the analytics snapshot, or the live database when forced or no snapshot exists yet"""
+    snapshot_engine = analytics_snapshot.engine
+    if live or ANALYTICS_FORCE_LIVE or not ANALYTICS_SNAPSHOT_ENABLED or snapshot_engine is None:
+        response.headers["X-Data-Source"] = "live"
+        with Session(engine) as session:
+            yield session
+        return
+
+    response.headers["X-Data-Source"] = "snapshot"
+    response.headers["X-Snapshot-Age"] = str(analytics_snapshot.age_seconds())
+    with Session(snapshot_engine) as session:
+        yield session
+
+class NotModified(Exception):
+    def __init__(self, etag: str):
+        self.etag = etag
+
+@app.exception_handler(NotModified)
+def not_modified_handler(request: Request, exc: NotModified):
+    return Response(status_code=304, headers={"ETag": exc.etag, "Cache-Control": "no-cache"})
+
+def etag_for(*models):
+    """Dependency that answers 304 when none of the models' tables changed since the client's ETag"""
+    tables = [model.__tablename__ for model in models]
+
+    def check_etag(request: Request, response: Response):
+        # Computed before the handler queries: a write landing in between pairs a newer body
+        # with an older ETag, which only costs the client one extra full response later
+        etag = table_versions.etag(tables)
+        if_none_match = request.headers.get("if-none-match", "")
+        if if_none_match.strip() == "*" or etag in [tag.strip() for tag in if_none_match.split(",")]:
+            raise NotModified(etag)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "no-cache"
+
+    return check_etag
+
 @app.on_event("startup")
 def create_db_and_tables():
     print("🚀 Starting Enhanced Shipment Management API...")
+    # WAL lets analytics snapshots and readers run without blocking writers
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
     SQLModel.metadata.create_all(engine)
+    migrate_to_autoincrement(Shipment, ShipmentArchive)
+    migrate_to_autoincrement(TrackingEvent, TrackingEventArchive)
+    # create_all skips indexes on tables that already exist, so add any new ones here
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
 
     with Session(engine) as session:
         # Create test users
@@ -547,6 +2240,25 @@ def create_db_and_tables():
             create_sample_shipments(session)
             print("✅ Sample shipments created")
 
+        # Resync unread counters in case notifications were written outside the API
+        rebuild_notification_counters(session)
+
+        if SHIPMENT_INDEX_ENABLED:
+            shipment_index.load(session)
+            print(f"✅ Shipment index loaded with {shipment_index.live_rows} active shipments")
+
+        # Build lane statistics on first run
+        existing_lane_stats = session.exec(select(LaneStats)).first()
+        if not existing_lane_stats:
+            lanes = refresh_lane_stats(session)
+            print(f"✅ Lane statistics built for {lanes} lanes")
+
+        # Build delivery-time sketches on first run; after that deliveries are folded as they happen
+        existing_sketches = session.exec(select(DeliverySketch)).first()
+        if not existing_sketches:
+            delivered = rebuild_delivery_sketches(session)
+            print(f"✅ Delivery-time sketches built from {delivered} deliveries")
+
     print("🌐 Server running at: http://localhost:8001")
     print("📚 API docs at: http://localhost:8001/docs")
     print("🔑 Login credentials:")
@@ -555,6 +2267,36 @@ def create_db_and_tables():
     print("   Employee: employee / employee123 (Suresh Kumar)")
     print("   Customer: testuser / password123 (Demo User)")
 
+sla_scanner_task: Optional[asyncio.Task] = None
+analytics_snapshot_task: Optional[asyncio.Task] = None
+archiver_task: Optional[asyncio.Task] = None
+
+async def run_analytics_snapshots():
+    """Refresh the analytics snapshot on a schedule without blocking the event loop"""
+    while True:
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, analytics_snapshot.refresh)
+        except Exception as e:
+            print(f"❌ Analytics snapshot error: {e}")
+        await asyncio.sleep(ANALYTICS_SNAPSHOT_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_sla_scanner():
+    global sla_scanner_task, analytics_snapshot_task, archiver_task
+    notification_hub.loop = asyncio.get_running_loop()
+    if SLA_SCANNER_ENABLED:
+        sla_scanner_task = asyncio.create_task(run_sla_scanner())
+    if ARCHIVER_ENABLED:
+        archiver_task = asyncio.create_task(run_archiver())
+    if ANALYTICS_SNAPSHOT_ENABLED:
+        analytics_snapshot_task = asyncio.create_task(run_analytics_snapshots())
+
+@app.on_event("shutdown")
+async def stop_sla_scanner():
+    for task in (sla_scanner_task, analytics_snapshot_task, archiver_task):
+        if task:
+            task.cancel()
+
 @app.post("/token")
 def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     """Login endpoint"""
@@ -572,9 +2314,8 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depend
         
         print(f"✅ Login successful for user: {form_data.username}")
         
-        # Simple token (not secure for production)
-        token = f"token_{user.username}_{user.id}"
-        return {"access_token": token, "token_type": "bearer"}
+        token = create_access_token(user)
+        return {"access_token": token, "token_type": "bearer", "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60}
         
     except HTTPException:
         raise
@@ -592,7 +2333,7 @@ def root():
     }
 
 # Shipment Endpoints
-@app.get("/shipments", response_model=List[Dict[str, Any]])
+@app.get("/shipments", response_model=List[Dict[str, Any]], dependencies=[Depends(etag_for(Shipment))])
 def get_shipments(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
@@ -654,7 +2395,7 @@ def get_shipments(
 @app.get("/shipments/{shipment_id}")
 def get_shipment(shipment_id: int, db: Session = Depends(get_db)):
     """Get a specific shipment by ID"""
-    shipment = db.exec(select(Shipment).where(Shipment.id == shipment_id)).first()
+    shipment, _ = find_shipment(db, "id", shipment_id)
     if not shipment:
         raise HTTPException(status_code=404, detail="Shipment not found")
 
@@ -683,46 +2424,71 @@ def get_shipment(shipment_id: int, db: Session = Depends(get_db)):
     }
 
 @app.post("/shipments")
-def create_shipment(shipment_data: ShipmentCreate, db: Session = Depends(get_db)):
+def create_shipment(
+    shipment_data: ShipmentCreate,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
     """Create a new shipment"""
+    return run_idempotent(db, "POST /shipments", idempotency_key, shipment_data, lambda: _create_shipment(shipment_data, db))
+
+def _create_shipment(shipment_data: ShipmentCreate, db: Session) -> Dict[str, Any]:
     shipment = Shipment(
-        tracking_number=generate_tracking_number(),
+        tracking_number=generate_tracking_number(db),
         **shipment_data.dict()
     )
 
-    # Calculate shipping cost based on weight and distance (simplified)
-    base_cost = 10.0
-    weight_cost = shipment.weight * 2.5
-    shipment.shipping_cost = round(base_cost + weight_cost, 2)
-
-    if shipment.insurance_required and shipment.declared_value:
-        shipment.insurance_cost = round(shipment.declared_value * 0.01, 2)
-    else:
-        shipment.insurance_cost = 0.0
+    # Default the ETA from the lane's delivery history when the client doesn't send one
+    if shipment.estimated_delivery_date is None:
+        transit_days, _, _ = estimate_transit_days(db, shipment.origin_city, shipment.destination_city, shipment.priority)
+        shipment.estimated_delivery_date = (datetime.utcnow() + timedelta(days=transit_days)).date()
 
-    shipment.total_cost = shipment.shipping_cost + shipment.insurance_cost
+    # Price with the shared rate card
+    quote = quote_shipments(
+        [shipment.origin_city], [shipment.destination_city], [shipment.weight], [shipment.dimensions],
+        [shipment.priority], [shipment.declared_value], [shipment.insurance_required]
+    )
+    shipment.shipping_cost = float(quote["shipping_cost"][0])
+    shipment.insurance_cost = float(quote["insurance_cost"][0])
+    shipment.total_cost = float(quote["total_cost"][0])
 
     db.add(shipment)
-    db.commit()
-    db.refresh(shipment)
+    db.flush()
 
     return {"message": "Shipment created successfully", "tracking_number": shipment.tracking_number, "id": shipment.id}
 
 @app.put("/shipments/{shipment_id}")
-def update_shipment(shipment_id: int, shipment_data: ShipmentUpdate, db: Session = Depends(get_db)):
+def update_shipment(shipment_id: int, shipment_data: ShipmentUpdate, background_tasks: BackgroundTasks,
+                    db: Session = Depends(get_db)):
     """Update a shipment"""
     shipment = db.exec(select(Shipment).where(Shipment.id == shipment_id)).first()
     if not shipment:
         raise HTTPException(status_code=404, detail="Shipment not found")
 
+    was_delivered = shipment.status == ShipmentStatus.DELIVERED
     update_data = shipment_data.dict(exclude_unset=True)
     for field, value in update_data.items():
         setattr(shipment, field, value)
 
     shipment.last_update = datetime.utcnow()
+    just_delivered = shipment.status == ShipmentStatus.DELIVERED and not was_delivered
+    if just_delivered and not shipment.actual_delivery_date:
+        shipment.actual_delivery_date = shipment.last_update
 
     db.add(shipment)
-    db.commit()
+    if just_delivered:
+        # Fold the delivery into the delivery-time sketches in the same transaction
+        with sketch_lock:
+            record_delivery(db, shipment)
+            db.commit()
+    else:
+        db.commit()
+
+    # Fold the new delivery into its lane's transit statistics once the response is on its way
+    if just_delivered:
+        background_tasks.add_task(
+            refresh_lane_stats_task, shipment.origin_city, shipment.destination_city, shipment.priority
+        )
 
     return {"message": "Shipment updated successfully"}
 
@@ -738,16 +2504,17 @@ def delete_shipment(shipment_id: int, db: Session = Depends(get_db)):
 
     return {"message": "Shipment deleted successfully"}
 
-@app.get("/shipments/track/{tracking_number}")
+@app.get("/shipments/track/{tracking_number}",
+         dependencies=[Depends(etag_for(Shipment, TrackingEvent, ShipmentArchive, TrackingEventArchive))])
 def track_shipment(tracking_number: str, db: Session = Depends(get_db)):
     """Track a shipment by tracking number"""
-    shipment = db.exec(select(Shipment).where(Shipment.tracking_number == tracking_number)).first()
+    shipment, event_model = find_shipment(db, "tracking_number", tracking_number)
     if not shipment:
         raise HTTPException(status_code=404, detail="Shipment not found")
 
     # Get tracking events
     tracking_events = db.exec(
-        select(TrackingEvent).where(TrackingEvent.shipment_id == shipment.id).order_by(TrackingEvent.timestamp)
+        select(event_model).where(event_model.shipment_id == shipment.id).order_by(event_model.timestamp)
     ).all()
 
     return {
@@ -772,22 +2539,52 @@ def track_shipment(tracking_number: str, db: Session = Depends(get_db)):
         ]
     }
 
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+
+def get_current_user_id(token: str = Depends(oauth2_scheme)) -> int:
+    """Verify the access token signature and expiry and return its user id"""
+    try:
+        claims = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        return int(claims["sub"])
+    except (JWTError, KeyError, ValueError):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid authentication token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+def get_current_principal(user_id: int = Depends(get_current_user_id)) -> UserPrincipal:
+    """Resolve the token's user, hitting the DB only on a cache miss"""
+    principal = principal_cache.get(user_id)
+    if principal is None:
+        with Session(engine) as session:
+            user = session.get(User, user_id)
+            if not user:
+                raise HTTPException(status_code=401, detail="User not found")
+            principal = UserPrincipal(**user.model_dump(exclude={"hashed_password"}))
+        principal_cache.put(principal)
+
+    if not principal.is_active:
+        raise HTTPException(status_code=403, detail="Inactive user")
+    return principal
+
+def require_roles(*roles: UserRole):
+    """Dependency factory that only lets the given roles through"""
+    def check_role(principal: UserPrincipal = Depends(get_current_principal)) -> UserPrincipal:
+        if principal.role not in roles:
+            raise HTTPException(status_code=403, detail="Not enough permissions")
+        return principal
+    return check_role
+
+require_staff = require_roles(UserRole.ADMIN, UserRole.MANAGER)
+
 @app.get("/users/me")
-def get_current_user():
-    """Get current user (simplified)"""
-    return {
-        "id": 1,
-        "username": "admin",
-        "email": "admin@shiptrack.in",
-        "full_name": "Rahul Sharma",
-        "role": "admin",
-        "company": "ShipTrack India Pvt Ltd",
-        "phone": "+91-98765-00001",
-        "is_active": True
-    }
+def get_current_user(principal: UserPrincipal = Depends(get_current_principal)):
+    """Get the authenticated user"""
+    return principal
 
 # Customer Endpoints
-@app.get("/customers")
+@app.get("/customers", dependencies=[Depends(etag_for(Customer))])
 def get_customers(
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=1000),
@@ -833,8 +2630,15 @@ def get_customers(
     return result
 
 @app.post("/customers")
-def create_customer(customer_data: CustomerCreate, db: Session = Depends(get_db)):
+def create_customer(
+    customer_data: CustomerCreate,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
     """Create a new customer"""
+    return run_idempotent(db, "POST /customers", idempotency_key, customer_data, lambda: _create_customer(customer_data, db))
+
+def _create_customer(customer_data: CustomerCreate, db: Session) -> Dict[str, Any]:
     # Check if email already exists
     existing_customer = db.exec(select(Customer).where(Customer.email == customer_data.email)).first()
     if existing_customer:
@@ -842,8 +2646,7 @@ def create_customer(customer_data: CustomerCreate, db: Session = Depends(get_db)
 
     customer = Customer(**customer_data.model_dump())
     db.add(customer)
-    db.commit()
-    db.refresh(customer)
+    db.flush()
 
     return {"message": "Customer created successfully", "id": customer.id}
 
@@ -854,8 +2657,9 @@ def get_customer(customer_id: int, db: Session = Depends(get_db)):
     if not customer:
         raise HTTPException(status_code=404, detail="Customer not found")
 
-    # Get customer's shipments
-    shipments = db.exec(select(Shipment).where(Shipment.customer_id == customer_id)).all()
+    # Get customer's shipments, including archived history
+    archived = db.exec(select(ShipmentArchive).where(ShipmentArchive.customer_id == customer_id)).all()
+    shipments = list(archived) + list(db.exec(select(Shipment).where(Shipment.customer_id == customer_id)).all())
 
     return {
         "id": customer.id,
@@ -881,12 +2685,125 @@ def get_customer(customer_id: int, db: Session = Depends(get_db)):
         ]
     }
 
+# Notification Endpoints
+NOTIFICATION_POLL_MAX_SECONDS = 30
+
+def notification_to_dict(notification: Notification) -> Dict[str, Any]:
+    return {
+        "id": notification.id,
+        "title": notification.title,
+        "message": notification.message,
+        "type": notification.type,
+        "read": notification.read,
+        "created_at": notification.created_at.isoformat()
+    }
+
+def get_unread_count(db: Session, user_id: int) -> int:
+    counter = db.get(NotificationCounter, user_id)
+    return counter.unread if counter else 0
+
+@app.get("/notifications")
+def get_notifications(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    unread_only: bool = False,
+    user_id: int = Depends(get_current_user_id),
+    db: Session = Depends(get_db)
+):
+    """Get the current user's notifications, newest first"""
+    query = select(Notification).where(Notification.user_id == user_id)
+    if unread_only:
+        query = query.where(Notification.read == False)
+    query = query.order_by(Notification.created_at.desc(), Notification.id.desc()).offset(skip).limit(limit)
+
+    return {
+        "unread_count": get_unread_count(db, user_id),
+        "notifications": [notification_to_dict(n) for n in db.exec(query).all()]
+    }
+
+@app.get("/notifications/unread-count")
+def get_notification_unread_count(user_id: int = Depends(get_current_user_id), db: Session = Depends(get_db)):
+    """Get the current user's unread notification count"""
+    return {"unread_count": get_unread_count(db, user_id)}
+
+@app.get("/notifications/poll")
+async def poll_notifications(
+    after_id: int = Query(0, ge=0),
+    timeout: int = Query(25, ge=0, le=NOTIFICATION_POLL_MAX_SECONDS),
+    user_id: int = Depends(get_current_user_id)
+):
+    """Long-poll: return as soon as the user has notifications newer than after_id"""
+    def fetch_new():
+        with Session(engine) as session:
+            rows = session.exec(
+                select(Notification)
+                .where(Notification.user_id == user_id, Notification.id > after_id)
+                .order_by(Notification.id)
+                .limit(100)
+            ).all()
+            return [notification_to_dict(n) for n in rows], get_unread_count(session, user_id)
+
+    loop = asyncio.get_running_loop()
+    # Subscribe before the first check so a notification written in between still wakes us
+    event = notification_hub.subscribe(user_id)
+    try:
+        notifications, unread_count = await loop.run_in_executor(None, copy_context().run, fetch_new)
+        if not notifications and timeout:
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                notifications, unread_count = await loop.run_in_executor(None, copy_context().run, fetch_new)
+    finally:
+        notification_hub.unsubscribe(user_id, event)
+
+    return {"unread_count": unread_count, "notifications": notifications}
+
+@app.post("/notifications/read-all")
+def mark_all_notifications_read(user_id: int = Depends(get_current_user_id), db: Session = Depends(get_db)):
+    """Mark all of the current user's notifications as read"""
+    result = db.exec(
+        update(Notification)
+        .where(Notification.user_id == user_id, Notification.read == False)
+        .values(read=True)
+    )
+    db.exec(update(NotificationCounter).where(NotificationCounter.user_id == user_id).values(unread=0))
+    db.commit()
+    return {"message": "All notifications marked as read", "updated": result.rowcount}
+
+@app.post("/notifications/{notification_id}/read")
+def mark_notification_read(
+    notification_id: int,
+    user_id: int = Depends(get_current_user_id),
+    db: Session = Depends(get_db)
+):
+    """Mark one notification as read"""
+    result = db.exec(
+        update(Notification)
+        .where(Notification.id == notification_id, Notification.user_id == user_id, Notification.read == False)
+        .values(read=True)
+    )
+    if result.rowcount:
+        db.exec(
+            update(NotificationCounter)
+            .where(NotificationCounter.user_id == user_id, NotificationCounter.unread > 0)
+            .values(unread=NotificationCounter.unread - 1)
+        )
+        db.commit()
+    elif not db.exec(
+        select(Notification.id).where(Notification.id == notification_id, Notification.user_id == user_id)
+    ).first():
+        raise HTTPException(status_code=404, detail="Notification not found")
+
+    return {"message": "Notification marked as read", "unread_count": get_unread_count(db, user_id)}
+
 # Analytics Endpoints
 @app.get("/analytics/dashboard")
-def get_dashboard_analytics(db: Session = Depends(get_db)):
+def get_dashboard_analytics(db: Session = Depends(get_analytics_db)):
     """Get dashboard analytics"""
-    # Get all shipments
-    shipments = db.exec(select(Shipment)).all()
+    # Get all shipments, including archived history
+    shipments = all_shipments(db)
     customers = db.exec(select(Customer)).all()
 
     # Calculate statistics
@@ -901,7 +2818,7 @@ def get_dashboard_analytics(db: Session = Depends(get_db)):
     delivered_with_dates = [s for s in shipments if s.status == ShipmentStatus.DELIVERED and s.actual_delivery_date and s.created_at]
     if delivered_with_dates:
         avg_delivery_time = sum(
-            (s.actual_delivery_date - s.created_at).days
+            (s.actual_delivery_date - s.created_at).total_seconds() / 86400
             for s in delivered_with_dates
         ) / len(delivered_with_dates)
     else:
@@ -926,9 +2843,9 @@ def get_dashboard_analytics(db: Session = Depends(get_db)):
     }
 
 @app.get("/analytics/shipments-by-status")
-def get_shipments_by_status(db: Session = Depends(get_db)):
+def get_shipments_by_status(db: Session = Depends(get_analytics_db)):
     """Get shipment count by status"""
-    shipments = db.exec(select(Shipment)).all()
+    shipments = all_shipments(db)
 
     status_counts = {}
     for status in ShipmentStatus:
@@ -937,9 +2854,9 @@ def get_shipments_by_status(db: Session = Depends(get_db)):
     return status_counts
 
 @app.get("/analytics/revenue-by-month")
-def get_revenue_by_month(db: Session = Depends(get_db)):
+def get_revenue_by_month(db: Session = Depends(get_analytics_db)):
     """Get revenue by month for the last 12 months"""
-    shipments = db.exec(select(Shipment)).all()
+    shipments = all_shipments(db)
 
     # Group by month
     monthly_revenue = {}
@@ -952,6 +2869,332 @@ def get_revenue_by_month(db: Session = Depends(get_db)):
 
     return monthly_revenue
 
+@app.get("/analytics/delivery-times")
+def get_delivery_time_analytics(
+    group_by: str = Query("all", pattern="^(all|priority|lane|month)$"),
+    key: Optional[str] = None,
+    db: Session = Depends(get_analytics_db)
+):
+    """Get delivery-time percentiles and histograms, grouped by priority, lane or month.
+
+    Deliveries are folded in when a shipment becomes delivered; deleting a delivered shipment or
+    editing its actual_delivery_date afterwards is not reflected until /admin/delivery-times/rebuild.
+    """
+    query = select(DeliverySketch).where(DeliverySketch.dimension == group_by)
+    if key:
+        query = query.where(DeliverySketch.key == key)
+    rows = db.exec(query.order_by(DeliverySketch.key)).all()
+
+    return {
+        "group_by": group_by,
+        "groups": {row.key: DeliveryTimeSketch(row).summary() for row in rows}
+    }
+
+@app.post("/admin/delivery-times/rebuild", dependencies=[Depends(require_staff)])
+def rebuild_delivery_times(db: Session = Depends(get_db)):
+    """Drop the persisted sketches and fold the full delivered history again, to resync after edits or deletes"""
+    folded = rebuild_delivery_sketches(db)
+    return {"message": "Delivery-time sketches rebuilt", "shipments": folded}
+
+# Lane Endpoints
+@app.get("/lanes/eta")
+def get_lane_eta(
+    origin_city: str,
+    destination_city: str,
+    priority: ShipmentPriority = ShipmentPriority.NORMAL,
+    db: Session = Depends(get_db)
+):
+    """Estimate delivery date for a lane from its delivery history"""
+    transit_days, source, stats = estimate_transit_days(db, origin_city, destination_city, priority)
+    return {
+        "origin_city": origin_city,
+        "destination_city": destination_city,
+        "priority": priority,
+        "transit_days": transit_days,
+        "estimated_delivery": (datetime.utcnow() + timedelta(days=transit_days)).date().isoformat(),
+        "source": source,
+        "sample_count": stats.sample_count if stats else 0
+    }
+
+@app.get("/lanes/stats")
+def get_lane_stats(
+    origin_city: Optional[str] = None,
+    destination_city: Optional[str] = None,
+    priority: Optional[ShipmentPriority] = None,
+    db: Session = Depends(get_db)
+):
+    """Get precomputed transit-time statistics per lane"""
+    query = select(LaneStats)
+    if origin_city:
+        query = query.where(LaneStats.origin_city == origin_city)
+    if destination_city:
+        query = query.where(LaneStats.destination_city == destination_city)
+    if priority:
+        query = query.where(LaneStats.priority == priority)
+    return db.exec(query).all()
+
+@app.post("/admin/lane-stats/rebuild", dependencies=[Depends(require_staff)])
+def rebuild_lane_stats(db: Session = Depends(get_db)):
+    """Recompute statistics for every lane from the delivered history"""
+    lanes = refresh_lane_stats(db)
+    return {"message": "Lane statistics rebuilt", "lanes": lanes}
+
+# Status Board Endpoints
+STATUS_BOARD_GROUP_FIELDS = {
+    "status": Shipment.status,
+    "priority": Shipment.priority,
+    "origin_city": Shipment.origin_city,
+    "destination_city": Shipment.destination_city
+}
+
+def _status_board_filters(status, priority, origin_city, destination_city, customer_id) -> Dict[str, Any]:
+    if status is not None and status not in OPEN_STATUSES:
+        raise HTTPException(status_code=422, detail="The status board only covers active shipments")
+    return {
+        "status": status,
+        "priority": priority,
+        "origin_city": origin_city,
+        "destination_city": destination_city,
+        "customer_id": customer_id
+    }
+
+def _status_board_query(query, filters: Dict[str, Any]):
+    """SQL equivalent of the index filters, used when the index is disabled"""
+    query = query.where(Shipment.status.in_(OPEN_STATUSES))
+    for name, value in filters.items():
+        if value is not None:
+            query = query.where(getattr(Shipment, name) == value)
+    return query
+
+@app.get("/status-board/count")
+def get_status_board_count(
+    status: Optional[ShipmentStatus] = None,
+    priority: Optional[ShipmentPriority] = None,
+    origin_city: Optional[str] = None,
+    destination_city: Optional[str] = None,
+    customer_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """Count active shipments matching the filters"""
+    filters = _status_board_filters(status, priority, origin_city, destination_city, customer_id)
+    if SHIPMENT_INDEX_ENABLED and shipment_index.loaded:
+        return {"count": shipment_index.count(**filters), "source": "index"}
+    count = db.exec(_status_board_query(select(func.count()).select_from(Shipment), filters)).one()
+    return {"count": count, "source": "database"}
+
+@app.get("/status-board/group-by")
+def get_status_board_groups(
+    field: str = Query(..., pattern="^(status|priority|origin_city|destination_city)$"),
+    status: Optional[ShipmentStatus] = None,
+    priority: Optional[ShipmentPriority] = None,
+    origin_city: Optional[str] = None,
+    destination_city: Optional[str] = None,
+    customer_id: Optional[int] = None,
+    db: Session = Depends(get_db)
+):
+    """Count active shipments matching the filters, grouped by one field"""
+    filters = _status_board_filters(status, priority, origin_city, destination_city, customer_id)
+    if SHIPMENT_INDEX_ENABLED and shipment_index.loaded:
+        return {"field": field, "groups": shipment_index.group_by(field, **filters), "source": "index"}
+
+    column = STATUS_BOARD_GROUP_FIELDS[field]
+    rows = db.exec(_status_board_query(select(column, func.count()), filters).group_by(column)).all()
+    return {
+        "field": field,
+        "groups": {key.value if isinstance(key, Enum) else key: count for key, count in rows},
+        "source": "database"
+    }
+
+@app.get("/status-board/index-stats", dependencies=[Depends(require_staff)])
+def get_shipment_index_stats():
+    """Get the in-memory shipment index size and memory footprint"""
+    return {"enabled": SHIPMENT_INDEX_ENABLED, "loaded": shipment_index.loaded, **shipment_index.memory_stats()}
+
+# Routing Endpoints
+@app.get("/network/hubs")
+def get_hub_network():
+    """Get the hubs and weighted lanes of the routing network"""
+    return {
+        "hubs": hub_network.hubs,
+        "lanes": [
+            {"from": hub_network.hubs[i], "to": hub_network.hubs[j], "distance_km": round(float(hub_network.dist[i, j]), 1)}
+            for i, j in sorted(hub_network.lanes)
+        ]
+    }
+
+@app.get("/shipments/{shipment_id}/route")
+def get_shipment_route(shipment_id: int, db: Session = Depends(get_db)):
+    """Get the hub path, next hop and remaining distance for a shipment"""
+    shipment, _ = find_shipment(db, "id", shipment_id)
+    if not shipment:
+        raise HTTPException(status_code=404, detail="Shipment not found")
+
+    route = hub_network.route(shipment.origin_city, shipment.destination_city, shipment.current_location)
+    if not route:
+        raise HTTPException(status_code=422, detail="Origin or destination is not on the hub network")
+    return {"shipment_id": shipment.id, "tracking_number": shipment.tracking_number, **route}
+
+@app.post("/routes/batch")
+def route_batch(request: RouteBatchRequest, db: Session = Depends(get_db)):
+    """Compute next hop and distances for many shipments or city pairs at once"""
+    if len(request.shipment_ids) + len(request.lanes) > 10000:
+        raise HTTPException(status_code=400, detail="At most 10000 routes per batch")
+
+    # Live rows win over archived ones, matching find_shipment
+    found = {}
+    for model in (ShipmentArchive, Shipment):
+        for start in range(0, len(request.shipment_ids), 500):
+            chunk = request.shipment_ids[start:start + 500]
+            found.update((row[0], row) for row in db.exec(
+                select(model.id, model.origin_city, model.destination_city, model.current_location)
+                .where(model.id.in_(chunk))
+            ).all())
+
+    rows = [found[shipment_id] for shipment_id in request.shipment_ids if shipment_id in found]
+    rows.extend((None, lane.get("from"), lane.get("to"), None) for lane in request.lanes)
+    routed = iter([])
+    if rows:
+        ids, origins, destinations, currents = zip(*rows)
+        routes = hub_network.route_many(origins, destinations, currents)
+        columns = {name: values.tolist() for name, values in routes.items()}
+        routed = iter([
+            {
+                "shipment_id": shipment_id,
+                "origin": origin,
+                "destination": destination,
+                "current_hub": current_hub,
+                "next_hop": next_hop,
+                "total_distance_km": total if known else None,
+                "remaining_distance_km": remaining if known else None
+            }
+            for shipment_id, origin, destination, known, current_hub, next_hop, total, remaining in zip(
+                ids, origins, destinations, columns["known"], columns["current_hub"], columns["next_hop"],
+                columns["total_distance_km"], columns["remaining_distance_km"]
+            )
+        ])
+
+    # One entry per requested shipment id, in request order, then one per lane
+    results = [
+        next(routed) if shipment_id in found else {"shipment_id": shipment_id, "found": False}
+        for shipment_id in request.shipment_ids
+    ]
+    results.extend(routed)
+    return {"count": len(results), "routes": results}
+
+# Quote Endpoints
+@app.post("/quotes/batch")
+def quote_batch(request: QuoteBatchRequest):
+    """Price many candidate shipments in one call"""
+    if len(request.items) > 10000:
+        raise HTTPException(status_code=400, detail="At most 10000 items per batch")
+    if not request.items:
+        return {"count": 0, "quotes": []}
+
+    items = request.items
+    quote = quote_shipments(
+        [i.origin_city for i in items], [i.destination_city for i in items], [i.weight for i in items],
+        [i.dimensions for i in items], [i.priority for i in items], [i.declared_value for i in items],
+        [i.insurance_required for i in items]
+    )
+    columns = {name: values.tolist() for name, values in quote.items()}
+
+    return {
+        "count": len(items),
+        "quotes": [
+            {"chargeable_weight": w, "shipping_cost": s, "insurance_cost": i, "total_cost": t}
+            for w, s, i, t in zip(columns["chargeable_weight"], columns["shipping_cost"],
+                                  columns["insurance_cost"], columns["total_cost"])
+        ]
+    }
+
+@app.get("/quotes/rates")
+def get_rate_card():
+    """Get the active rate card"""
+    return rate_card
+
+@app.put("/admin/quotes/rates", dependencies=[Depends(require_staff)])
+def update_rate_card(card: RateCard):
+    """Replace the active rate card"""
+    global rate_card
+    rate_card = card
+    return {"message": "Rate card updated"}
+
+# SLA Endpoints
+@app.post("/admin/sla-scan", dependencies=[Depends(require_staff)])
+def run_sla_scan(
+    batch_size: int = Query(SLA_SCAN_BATCH_SIZE, ge=1, le=10000),
+    db: Session = Depends(get_db)
+):
+    """Run an SLA-breach sweep now"""
+    breaches = scan_sla_breaches(db, batch_size)
+    return {"message": "SLA scan completed", "breaches": breaches}
+
+@app.get("/admin/sla-scan/status", dependencies=[Depends(require_staff)])
+def get_sla_scan_status(db: Session = Depends(get_db)):
+    """Get the SLA scanner's watermark and schedule"""
+    watermark = db.get(ScanWatermark, "sla_breaches")
+    return {
+        "enabled": SLA_SCANNER_ENABLED,
+        "running": bool(sla_scanner_task and not sla_scanner_task.done()),
+        "interval_seconds": SLA_SCAN_INTERVAL_SECONDS,
+        "batch_size": SLA_SCAN_BATCH_SIZE,
+        "scanned_through": watermark.last_timestamp.date().isoformat() if watermark and watermark.last_timestamp else None,
+        "watermark_updated_at": watermark.updated_at.isoformat() if watermark else None
+    }
+
+# Analytics Snapshot Endpoints
+@app.get("/analytics/snapshot")
+def get_analytics_snapshot_status():
+    """Get the age and schedule of the analytics snapshot"""
+    return {
+        "enabled": ANALYTICS_SNAPSHOT_ENABLED,
+        "force_live": ANALYTICS_FORCE_LIVE,
+        "taken_at": analytics_snapshot.taken_at.isoformat() if analytics_snapshot.taken_at else None,
+        "age_seconds": analytics_snapshot.age_seconds(),
+        "last_refresh_ms": analytics_snapshot.last_duration_ms,
+        "interval_seconds": ANALYTICS_SNAPSHOT_INTERVAL_SECONDS
+    }
+
+@app.post("/admin/analytics/snapshot", dependencies=[Depends(require_staff)])
+def refresh_analytics_snapshot():
+    """Refresh the analytics snapshot now"""
+    analytics_snapshot.refresh()
+    return {"message": "Analytics snapshot refreshed", "taken_at": analytics_snapshot.taken_at.isoformat()}
+
+@app.put("/admin/analytics/force-live", dependencies=[Depends(require_staff)])
+def set_analytics_force_live(enabled: bool):
+    """Switch all analytics reads to the live database, or back to the snapshot"""
+    global ANALYTICS_FORCE_LIVE
+    ANALYTICS_FORCE_LIVE = enabled
+    return {"message": "Analytics source updated", "force_live": ANALYTICS_FORCE_LIVE}
+
+# Metrics Endpoints
+@app.get("/admin/metrics", dependencies=[Depends(require_staff)])
+def get_metrics():
+    """Get admission control counters"""
+    return {"admission": admission.snapshot()}
+
+# Archive Endpoints
+@app.post("/admin/archive", dependencies=[Depends(require_staff)])
+def run_archive(
+    older_than_days: int = Query(ARCHIVE_AFTER_DAYS, ge=0),
+    batch_size: int = Query(ARCHIVE_BATCH_SIZE, ge=1, le=10000),
+    db: Session = Depends(get_db)
+):
+    """Archive terminal shipments older than the given age"""
+    result = archive_terminal_shipments(db, older_than_days, batch_size)
+    return {"message": "Archive run completed", **result}
+
+@app.get("/admin/archive/stats", dependencies=[Depends(require_staff)])
+def get_archive_stats(db: Session = Depends(get_db)):
+    """Get live vs archived row counts"""
+    return {
+        "live_shipments": db.exec(select(func.count()).select_from(Shipment)).one(),
+        "archived_shipments": db.exec(select(func.count()).select_from(ShipmentArchive)).one(),
+        "live_tracking_events": db.exec(select(func.count()).select_from(TrackingEvent)).one(),
+        "archived_tracking_events": db.exec(select(func.count()).select_from(TrackingEventArchive)).one()
+    }
+
 @app.get("/health")
 def health_check():
     """Health check endpoint"""